@@ -7,11 +7,14 @@
 │ where it will be accessed by other parts.                   │
 │                                                             │
 │ Usage:                                                      │
-│     python3 batch.py batchfiles [-break|-b]                 │
+│     python3 batch.py batchfiles [-break|-b] [-workers|-w N] │
 │                                                             │
 │     batchfiles    files with batch configuration            │
 │     -break, -b    if this is given, the programm will break │
 │                     when an exception is encountered        │
+│     -workers, -w  number of processes to train classifiers  │
+│     -cpus, -c     number of processors for parallel tasks   │
+│     -folds, -f    number of processes to train CV folds     │
 └─────────────────────────────────────────────────────────────┘
 """
 
@@ -19,7 +22,7 @@
 import traceback
 import sys
 from datetime import datetime
-from modules import cache, data, classification, projection, tools, job_compiler
+from modules import cache, data, classification, projection, tools, job_compiler, parallel, scheduler
 from termcolor import cprint, colored
 import json
 # import keras to initialize it before loading plugins
@@ -28,8 +31,9 @@ from os import environ
 import colorama
 
 colorama.init()
-print('Setting environ["CUDA_VISIBLE_DEVICES"] = "0"')
-environ['CUDA_VISIBLE_DEVICES'] = '0'
+if 'CUDA_VISIBLE_DEVICES' not in environ:
+    print('Setting environ["CUDA_VISIBLE_DEVICES"] = "0"')
+    environ['CUDA_VISIBLE_DEVICES'] = '0'
 
 
 ########### CONFIG ###########
@@ -39,6 +43,38 @@ environ['CUDA_VISIBLE_DEVICES'] = '0'
 # (can be set to True by -break argument)
 break_on_exception = False
 
+# Number of worker processes that train classifiers in parallel
+# (can be set by the -workers N argument)
+n_workers = 1
+
+# Number of worker processes that train the cross validation folds
+# of a classifier in parallel, only used when classifiers are trained
+# one after another (can be set by the -folds N argument)
+n_fold_workers = 1
+
+# Number of processors that projections and classifiers may use in total
+# If larger than 1, projections run in parallel processes and
+# classifiers are scheduled based on the resources they need
+# (see resources in modules/classifiers/README.md)
+# None means one task at a time using all processors
+# (can be set by the -cpus N argument)
+cpu_budget = None
+
+# Memory limit in MB for predicting large datasets, data is passed to the
+# classifiers in batches that fit into it, None predicts all data at once
+# It does not change the results, so it is not part of the job's config
+# (can be set by the -predmem MB argument)
+max_prediction_memory = None
+
+# Memory in MB that classifiers may use in total when they are scheduled,
+# None means 80% of the physical memory
+memory_budget = None
+
+# Number of classifiers with accelerator 'gpu' (TensorFlow models)
+# that may run at the same time when they are scheduled,
+# they share the GPU's memory
+max_gpu_tasks = 1
+
 # Display the content of the batch job file when it is loaded?
 # (useful for logs)
 show_batch_config = False
@@ -48,10 +84,40 @@ show_batch_config = False
 cache_log = False
 cache_path = 'cache/'
 
+# How predictions and probabilities are stored in the cache:
+# 'columnar' appends them to one matrix per dataset (fastest to read),
+# 'npy' writes raw NumPy arrays that are read memory-mapped,
+# 'pickle' writes pickled lists (the format of older caches)
+# All formats can always be read
+cache_array_format = 'columnar'
+
+# Precision of stored probabilities and projected coordinates:
+# 'float64', 'float32', 'float16' or 'uint8' (probabilities quantized
+# to 256 levels), predicted labels use uint8 or uint16 unless 'float64'
+# Values are converted to float32 or float64 when they are read
+cache_precision = 'float32'
+
+# Compression of pickled cache files: 'none', 'zlib', 'lz4' (needs the
+# lz4 package), 'lzma' or 'zstd' (needs the zstandard package), with a
+# level from 1 (fastest) to 9 (smallest)
+# Files written with any codec can always be read (as long as its package
+# is installed), compare the codecs on your cache with the (b)enchmark
+# action of explorer.py
+cache_codec = 'none'
+cache_codec_level = 3
+
 ##############################
 
-tools.version_checks()
-cache.init(cache_path, log_actions=cache_log)
+
+def init():
+    """
+    Initializes the cache, called by main() only, since worker processes
+    import this module again and initialize the cache themselves.
+    """
+    tools.version_checks()
+    cache.init(cache_path, log_actions=cache_log,
+               array_format=cache_array_format, precision=cache_precision,
+               codec=cache_codec, codec_level=cache_codec_level)
 
 
 def run_job(batch_file, current_job, n_jobs, t0):
@@ -77,7 +143,6 @@ def run_job(batch_file, current_job, n_jobs, t0):
     data_args = args['data']
     cprint(f'\n\nRunning batch job {data_args["title"]}', 'cyan')
     data_cache = tools.hash(data_args, 'data_')
-    cache_entries = cache.entries()
 
     # get data
     print(colored('\n\nLoading data', 'cyan'), end='')
@@ -91,6 +156,60 @@ def run_job(batch_file, current_job, n_jobs, t0):
     # project
     cprint('\n\n\nProjecting data', 'cyan')
     projs = args['projections']
+    if cpu_budget is not None and cpu_budget > 1:
+        errors += run_projections_parallel(projs, data_cache, data_bundle,
+                                           current_job, n_jobs, t0)
+    else:
+        errors += run_projections(projs, data_cache, data_bundle,
+                                  current_job, n_jobs, t0)
+
+    # classify
+    cprint('\n\n\nRunning classifiers', 'cyan')
+    clfs = args['classifiers']
+    utilization = None
+    if n_workers > 1:
+        errors += run_classifiers_parallel(clfs, data_cache, data_bundle,
+                                           current_job, n_jobs, t0)
+    elif cpu_budget is not None and cpu_budget > 1:
+        clf_errors, utilization = run_classifiers_scheduled(
+            clfs, data_cache, data_bundle, current_job, n_jobs, t0)
+        errors += clf_errors
+    else:
+        errors += run_classifiers(clfs, data_cache, data_bundle,
+                                  current_job, n_jobs, t0)
+
+    tools.print_time_elapsed(t0, prefix=colored(
+        f'\n\nFinished job {current_job} of {n_jobs}', 'green'), end='\n\n')
+
+    # print errors if any happened
+    if len(errors) > 0:
+        cprint(
+            f'{len(errors)} errors! The following classifier configurations failed:', 'red')
+        for error in errors:
+            print(error)
+
+    # return summary
+    return {
+        'title': data_args["title"],
+        'dataset': data_args["dataset"],
+        'n_clfs': len(clfs),
+        'n_projs': len(projs),
+        'errors': errors,
+        'time': datetime.now() - t_start,
+        'utilization': utilization
+    }
+
+
+def run_projections(projs, data_cache, data_bundle, current_job, n_jobs, t0):
+    """
+    Projects the data with one projection after another.
+
+    Returns:
+    - errors in the same format as in run_job()
+    """
+    errors = []
+    # combine train and test data only once for all projections
+    X_combined = None
     current = 1
     for proj_args in projs:
         try:
@@ -100,12 +219,16 @@ def run_job(batch_file, current_job, n_jobs, t0):
             # cache lookup
             proj_cache = '{}__proj_{}'.format(
                 data_cache, tools.hash(proj_args))
-            if proj_cache in cache_entries:
+            if cache.contains(proj_cache):
                 cprint('already cached!', 'green')
             else:
                 tools.print_time_elapsed(t0, end='\n')
                 # projection
-                projection.project(proj_args, proj_cache, data_bundle)
+                if X_combined is None:
+                    X_combined = projection.combine_data(data_bundle)
+                projection.project(proj_args, proj_cache, data_bundle,
+                                   X_combined=X_combined,
+                                   n_jobs=cpu_budget or -1)
         except KeyboardInterrupt:
             cprint('\nKeyboardInterrupt, exiting', 'yellow')
             exit()
@@ -114,52 +237,243 @@ def run_job(batch_file, current_job, n_jobs, t0):
             cprint(e, 'red')
             if break_on_exception:
                 raise
+    return errors
 
-    # classify
-    cprint('\n\n\nRunning classifiers', 'cyan')
-    clfs = args['classifiers']
+
+def run_projections_parallel(projs, data_cache, data_bundle, current_job, n_jobs, t0):
+    """
+    Projects the data with a pool of processes that uses at most
+    cpu_budget processors in total. Each process gets an equal share
+    of the budget as threads for methods that support multi-threading.
+    The combined data is shared with the workers via a memory-mapped file.
+
+    Returns:
+    - errors in the same format as in run_job()
+    """
+    tasks = []
+    for proj_args in projs:
+        proj_cache = '{}__proj_{}'.format(data_cache, tools.hash(proj_args))
+        if cache.contains(proj_cache):
+            cprint(f'  already cached: {proj_args["title"]}', 'green')
+        else:
+            tasks.append((proj_args, proj_cache))
+    if len(tasks) == 0:
+        return []
+
+    workers = min(cpu_budget, len(tasks))
+    n_threads = max(1, cpu_budget // workers)
+    tasks = [(proj_args, proj_cache, n_threads)
+             for proj_args, proj_cache in tasks]
+    # training and test data are slices of the combined data,
+    # so only the combined data is shared
+    bundle = {k: v for k, v in data_bundle.items()
+              if k not in ('X_train', 'X_test')}
+    bundle['X_combined'] = projection.combine_data(data_bundle)
+    return run_in_pool(parallel.run_projections, tasks, bundle, workers,
+                       n_threads, 'Projection', current_job, n_jobs, t0)
+
+
+def run_classifiers(clfs, data_cache, data_bundle, current_job, n_jobs, t0):
+    """
+    Trains classifiers one after another.
+
+    Returns:
+    - errors in the same format as in run_job()
+    """
+    errors = []
     current = 1
+    fold_pool, shared = get_fold_pool(data_bundle)
+    try:
+        for clf_args in clfs:
+            try:
+                print(
+                    f'\n\nJob {current_job} of {n_jobs}, classifier {current} of {len(clfs)} ', end='')
+                current += 1
+                # cache lookup
+                clf_cache = '{}__clf_{}'.format(
+                    data_cache, tools.hash(clf_args))
+                if cache.contains(clf_cache):
+                    cprint('already cached!', 'green')
+                else:
+                    tools.print_time_elapsed(t0, end='\n')
+                    # classification
+                    classification.classify(
+                        clf_args, clf_cache, data_bundle, fold_pool=fold_pool,
+                        max_memory=get_max_prediction_memory())
+            except KeyboardInterrupt:
+                cprint('\nKeyboardInterrupt, exiting', 'yellow')
+                exit()
+            except Exception as e:
+                errors.append(f'Classifier: {clf_args["title"]}')
+                cprint(e, 'red')
+                if break_on_exception:
+                    raise
+    finally:
+        if fold_pool is not None:
+            fold_pool.terminate()
+            parallel.remove_bundle(shared)
+    return errors
+
+
+def get_max_prediction_memory():
+    """
+    Returns max_prediction_memory in bytes or None.
+    """
+    if max_prediction_memory is None:
+        return None
+    return max_prediction_memory * 2**20
+
+
+def get_fold_pool(data_bundle):
+    """
+    Creates the pool of n_fold_workers processes that trains the cross
+    validation folds of all classifiers of a job, so the data is exported
+    and the workers are started only once.
+    The processors (cpu_budget or all) are shared between the workers.
+
+    Returns:
+    - pool or None if the folds are trained one after another
+    - output of parallel.export_bundle() or None
+    """
+    if n_fold_workers <= 1 or not classification.uses_cross_validation(data_bundle):
+        return None, None
+    # workers get the splits with the bundle
+    n_folds = len(classification.get_fold_indices(data_bundle))
+    cpus = cpu_budget or scheduler.get_machine_resources()[0]
+    workers = min(n_fold_workers, n_folds, cpus)
+    if workers <= 1:
+        return None, None
+    n_threads = max(1, cpus // workers)
+    cprint(
+        f'\nTraining folds with {workers} worker processes', 'cyan')
+    shared = parallel.export_bundle(data_bundle)
+    return parallel.get_pool(workers, shared, n_threads), shared
+
+
+def run_classifiers_parallel(clfs, data_cache, data_bundle, current_job, n_jobs, t0):
+    """
+    Trains classifiers with a pool of n_workers processes.
+    The data is shared with the workers via memory-mapped files.
+
+    Returns:
+    - errors in the same format as in run_job()
+    """
+    # only send classifiers that are not cached yet
+    tasks = []
     for clf_args in clfs:
-        try:
-            print(
-                f'\n\nJob {current_job} of {n_jobs}, classifier {current} of {len(clfs)} ', end='')
-            current += 1
-            # cache lookup
-            clf_cache = '{}__clf_{}'.format(data_cache, tools.hash(clf_args))
-            if clf_cache in cache_entries:
-                cprint('already cached!', 'green')
-            else:
-                tools.print_time_elapsed(t0, end='\n')
-                # classification
-                classification.classify(clf_args, clf_cache, data_bundle)
-        except KeyboardInterrupt:
-            cprint('\nKeyboardInterrupt, exiting', 'yellow')
-            exit()
-        except Exception as e:
-            errors.append(f'Classifier: {clf_args["title"]}')
-            cprint(e, 'red')
+        clf_cache = '{}__clf_{}'.format(data_cache, tools.hash(clf_args))
+        if cache.contains(clf_cache):
+            cprint(f'  already cached: {clf_args["title"]}', 'green')
+        else:
+            tasks.append((clf_args, clf_cache, get_max_prediction_memory()))
+    if len(tasks) == 0:
+        return []
+
+    workers = min(n_workers, len(tasks))
+    return run_in_pool(parallel.run_classifiers, tasks, data_bundle, workers,
+                       None, 'Classifier', current_job, n_jobs, t0)
+
+
+def run_classifiers_scheduled(clfs, data_cache, data_bundle, current_job, n_jobs, t0):
+    """
+    Trains classifiers in parallel processes within cpu_budget
+    and memory_budget, based on the resources each classifier needs.
+
+    Returns:
+    - errors in the same format as in run_job()
+    - utilization report, see scheduler.get_utilization()
+    """
+    _, machine_memory = scheduler.get_machine_resources()
+    memory = memory_budget
+    if memory is None and machine_memory is not None:
+        memory = int(machine_memory * 0.8)
+    data_memory = (data_bundle['X_train'].nbytes
+                   + data_bundle['X_test'].nbytes) // 2**20
+
+    tasks = []
+    for clf_args in clfs:
+        clf_cache = '{}__clf_{}'.format(data_cache, tools.hash(clf_args))
+        if cache.contains(clf_cache):
+            cprint(f'  already cached: {clf_args["title"]}', 'green')
+        else:
+            resources = scheduler.get_task_resources(
+                clf_args, data_memory, cpu_budget)
+            tasks.append((clf_args, clf_cache, resources))
+    if len(tasks) == 0:
+        return [], None
+
+    cprint(
+        f'\nScheduling {len(tasks)} classifier tasks on {cpu_budget} processors', 'cyan')
+    shared = parallel.export_bundle(data_bundle)
+    on_finished = get_progress_callback(
+        'Classifier', len(tasks), current_job, n_jobs, t0)
+    try:
+        failed, utilization = scheduler.run_classifiers(
+            tasks, shared, cpu_budget, memory, max_gpu_tasks, on_finished,
+            max_memory=get_max_prediction_memory())
+    except KeyboardInterrupt:
+        cprint('\nKeyboardInterrupt, exiting', 'yellow')
+        exit()
+    finally:
+        parallel.remove_bundle(shared)
+
+    return [f'Classifier: {title}' for title, _ in failed], utilization
+
+
+def get_progress_callback(name, n_tasks, current_job, n_jobs, t0):
+    """
+    Returns a callback for parallel tasks that prints the progress
+    and raises an exception for failed tasks if break_on_exception.
+    """
+    finished = 0
+
+    def on_finished(title, error):
+        nonlocal finished
+        finished += 1
+        print(
+            f'\n\nJob {current_job} of {n_jobs}, finished {name.lower()} {finished} of {n_tasks} ', end='')
+        tools.print_time_elapsed(t0, end='\n')
+        if error is not None:
+            cprint(f'{name} {title} failed: {error}', 'red')
             if break_on_exception:
-                raise
+                raise Exception(error)
 
-    tools.print_time_elapsed(t0, prefix=colored(
-        f'\n\nFinished job {current_job} of {n_jobs}', 'green'), end='\n\n')
+    return on_finished
 
-    # print errors if any happened
-    if len(errors) > 0:
-        cprint(
-            f'{len(errors)} errors! The following classifier configurations failed:', 'red')
-        for error in errors:
-            print(error)
 
-    # return summary
-    return {
-        'title': data_args["title"],
-        'dataset': data_args["dataset"],
-        'n_clfs': len(clfs),
-        'n_projs': len(projs),
-        'errors': errors,
-        'time': datetime.now() - t_start
-    }
+def run_in_pool(run, tasks, data_bundle, workers, n_threads, name, current_job, n_jobs, t0):
+    """
+    Runs tasks in a pool of worker processes that share the data bundle.
+
+    Keyword arguments:
+    - run: parallel.run_classifiers or parallel.run_projections
+    - tasks: tasks for run
+    - data_bundle: data that is shared with the workers
+    - workers: number of processes
+    - n_threads: number of threads per process or None for no limit
+    - name: Classifier or Projection, used for messages and errors
+
+    Returns:
+    - errors in the same format as in run_job()
+    """
+    cprint(
+        f'\nRunning {len(tasks)} {name.lower()} tasks with {workers} worker processes', 'cyan')
+    shared = parallel.export_bundle(data_bundle)
+    pool = parallel.get_pool(workers, shared, n_threads)
+    on_finished = get_progress_callback(
+        name, len(tasks), current_job, n_jobs, t0)
+    try:
+        failed = run(tasks, pool, on_finished)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        cprint('\nKeyboardInterrupt, exiting', 'yellow')
+        exit()
+    finally:
+        pool.terminate()
+        parallel.remove_bundle(shared)
+
+    return [f'{name}: {title}' for title, _ in failed]
 
 
 def print_summary(summaries):
@@ -215,6 +529,25 @@ def print_summary(summaries):
         str(total_time).split('.', 2)[0]
     ))
 
+    # print utilization for jobs with scheduled classifiers
+    scheduled = [s for s in summaries if s.get('utilization') is not None]
+    if len(scheduled) > 0:
+        format_str = '{:40}  {:6}  {:>8}  {:>8}  {:>10}  {:>12}  {:>8}'
+        cprint('\nUtilization of scheduled classifiers', 'cyan')
+        cprint(format_str.format('Title', '#Tasks', 'CPU res.', 'CPU used',
+                                 'Peak tasks', 'Peak mem. MB', 'GPU busy'), 'cyan')
+        for summary in scheduled:
+            u = summary['utilization']
+            print(format_str.format(
+                summary['title'][:40],
+                u['tasks'],
+                f'{u["cpu_reserved"]:.0%}',
+                f'{u["cpu_used"]:.0%}',
+                u['peak_tasks'],
+                u['peak_memory'],
+                f'{u["gpu_busy"]:.0%}'
+            ))
+
     # print errors for each job
     if total_errors == 0:
         cprint('\nNo errors in the above jobs!', 'green')
@@ -231,7 +564,7 @@ def print_summary(summaries):
 def show_help():
     print("""
     Usage:
-        python3 batch.py jobfile1 [jobfile2 [jobfile...]] [-b|-break]
+        python3 batch.py jobfile1 [jobfile2 [jobfile...]] [-b|-break] [-w|-workers N] [-c|-cpus N] [-f|-folds N] [-p|-predmem MB]
 
         Make sure you have installed all packages and are inside the virtual environment!
         See README.md for information on how to create batch jobs.
@@ -244,6 +577,24 @@ def show_help():
                     it will ignore exceptions when possible and
                     continue the current job or start the next one.
 
+        -w -workers N
+                    Trains classifiers with N worker processes in parallel.
+                    By default, they are trained one after another.
+                    Cannot be combined with -cpus.
+
+        -c -cpus N  Runs projections and classifiers in parallel using
+                    at most N processors. Classifiers are scheduled
+                    based on the threads, memory and GPU they need.
+                    By default, they run one after another.
+
+        -f -folds N Trains the cross validation folds of each classifier
+                    with N worker processes in parallel, when classifiers
+                    are trained one after another.
+
+        -p -predmem MB
+                    Predicts data in batches that fit into MB megabytes,
+                    for datasets that do not fit into memory at once.
+
         -h -help    Shows this information and exits.
     """)
 
@@ -257,27 +608,59 @@ def main():
     │ BATCH CONFIG RUNNER │
     └─────────────────────┘
     """)
-    global break_on_exception
+    global break_on_exception, n_workers, cpu_budget, n_fold_workers, \
+        max_prediction_memory
     t0 = datetime.now()
 
     # get files and arguments
     jobs = []
     should_show_help = False
-    for arg in sys.argv[1:]:
+    argv = iter(sys.argv[1:])
+    for arg in argv:
         # arguments
         if arg in ['-b', '-break']:
             break_on_exception = True
         elif arg in ['-h', '-help']:
             should_show_help = True
+        elif arg in ['-w', '-workers', '--workers']:
+            try:
+                n_workers = max(1, int(next(argv)))
+            except (StopIteration, ValueError):
+                cprint('-workers must be followed by a number', 'red')
+                should_show_help = True
+        elif arg in ['-c', '-cpus', '--cpus']:
+            try:
+                cpu_budget = max(1, int(next(argv)))
+            except (StopIteration, ValueError):
+                cprint('-cpus must be followed by a number', 'red')
+                should_show_help = True
+        elif arg in ['-f', '-folds', '--folds']:
+            try:
+                n_fold_workers = max(1, int(next(argv)))
+            except (StopIteration, ValueError):
+                cprint('-folds must be followed by a number', 'red')
+                should_show_help = True
+        elif arg in ['-p', '-predmem', '--predmem']:
+            try:
+                max_prediction_memory = max(1, int(next(argv)))
+            except (StopIteration, ValueError):
+                cprint('-predmem must be followed by a number', 'red')
+                should_show_help = True
         # files
         else:
             cprint(f'added job: {arg}', 'green')
             jobs.append(arg)
 
+    # the scheduler decides how many classifiers run in parallel
+    if n_workers > 1 and cpu_budget is not None:
+        cprint('-workers cannot be combined with -cpus, use -cpus only to run classifiers in parallel within the processor budget', 'red')
+        should_show_help = True
+
     # check if there are any jobs
     if should_show_help or len(jobs) == 0:
         show_help()
         return
+    init()
 
     # exception handling
     if break_on_exception:
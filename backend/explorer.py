@@ -1,6 +1,6 @@
 import json
 from termcolor import cprint, colored
-from modules import cache, tools
+from modules import cache, prediction_store, tools
 from datetime import datetime
 import os
 import colorama
@@ -20,6 +20,9 @@ colorama.init()
 ########### CONFIG ###########
 log_cache_actions = False
 cache_path = 'cache/'
+# compression level and number of files for the codec benchmark
+benchmark_level = 3
+benchmark_files = 20
 ##############################
 
 tools.version_checks()
@@ -77,6 +80,35 @@ def show_args(item):
                 cprint(value, 'cyan')
 
 
+def show_codec_benchmark():
+    """
+    Prints the codecs of the cached files and how each codec
+    performs on them
+    """
+    print('\nFiles per codec')
+    for codec, count in cache.codecs().items():
+        print('  {:15} : '.format(str(codec)), end='')
+        cprint(count, 'cyan')
+
+    cprint('\nBenchmarking codecs on the largest cached files...', 'yellow')
+    results = cache.benchmark_codecs(level=benchmark_level,
+                                     max_files=benchmark_files)
+    if len(results) == 0:
+        cprint('No pickled files in the cache', 'red')
+        return
+    format_str = '{:8}  {:>6}  {:>10}  {:>10}  {:>7}  {:>12}  {:>12}'
+    cprint(format_str.format('Codec', 'Files', 'Raw MB', 'MB', 'Ratio',
+                             'Write MB/s', 'Read MB/s'), 'green')
+    for r in results:
+        print(format_str.format(r['codec'],
+                                r['files'],
+                                f'{r["raw_size"]:.1f}',
+                                f'{r["size"]:.1f}',
+                                f'{r["ratio"]:.2f}',
+                                f'{r["write"]:.1f}',
+                                f'{r["read"]:.1f}'))
+
+
 def clear_screen():
     """
     Clears the console
@@ -127,11 +159,23 @@ def main():
             i += 1
 
         action = input(
-            colored('\nAction: (s)how (d)elete (r)efresh (q)uit: ', 'yellow'))
+            colored('\nAction: (s)how (d)elete (r)efresh re(i)ndex (b)enchmark codecs (q)uit: ', 'yellow'))
         # refresh
         if action == 'r':
             continue
 
+        # rebuild the cache index, e.g. after copying files by hand
+        if action == 'i':
+            cache.rebuild_index()
+            input(colored('Press enter to continue', 'yellow'))
+            continue
+
+        # compare compression codecs on the cached files
+        if action == 'b':
+            show_codec_benchmark()
+            input(colored('Press enter to continue', 'yellow'))
+            continue
+
         # quit
         if action == 'q':
             print('bye!')
@@ -229,6 +273,7 @@ def main():
                             if confirm == 'y' or confirm.strip() == '':
                                 cache.delete(
                                     item['file'].replace('_args.json', ''))
+                                prediction_store.compact(dataset_hash)
                                 cprint('Deleted.', 'green')
 
                 except Exception as e:
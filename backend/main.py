@@ -3,15 +3,21 @@
 # initialize keras already here
 import keras
 import json
+import os
+from pathlib import Path
 from termcolor import cprint
 from modules.classifiers import get_classifier_info
 from modules.datasets import get_datasets_info
-from modules import cache, data, projection, tools
+from modules import cache, data, prediction_store, projection, tools, transport
 from flask_restful import Resource, Api
 from flask_jsonpify import jsonify, jsonpify
 from flask_cors import CORS
-from flask import Flask, request
+from flask import Flask, Response, request
+from werkzeug.wsgi import wrap_file
 from datetime import datetime
+from hashlib import md5
+import threading
+from time import time, perf_counter
 import colorama
 colorama.init()
 
@@ -35,6 +41,20 @@ debug = True
 send_on_exception = False
 log_cache_actions = False
 cache_path = 'cache/'
+# MB of cached files kept in memory, so reloading the frontend
+# does not read them from disk again, 0 disables it
+memory_cache_size = 1024
+# number of files get_clf_results reads at the same time
+read_threads = 8
+# decimals of floats in arrays sent as JSON, None sends them exactly
+json_float_decimals = None
+# compress responses with zstd, brotli or gzip if the client accepts it,
+# the level is the encoding's default if None
+compress_responses = True
+compression_level = None
+# store serialized projections in the cache directory when they are
+# sent the first time and send the stored files later
+store_responses = True
 show_request_args = False
 ##############################
 
@@ -44,18 +64,249 @@ print("""
     └────────────────┘
 """)
 
-tools.version_checks()
-
 # flask setup
 app = Flask(__name__)
 api = Api(app)
 CORS(app)
 
+# state that is created once and kept for all requests
+server = {
+    'ready': False,
+    'error': None,
+    'started': time(),
+    'info': None
+}
+_init_lock = threading.Lock()
+
+
+def init_server():
+    """
+    Initializes the cache and collects the plugins' information once,
+    later calls return immediately.
+    """
+    with _init_lock:
+        if server['ready']:
+            return
+        try:
+            t0 = time()
+            tools.version_checks()
+            cache.init(cache_path, log_actions=log_cache_actions,
+                       memory_cache_size=memory_cache_size)
+            # open the index and count the entries, so the
+            # first request does not have to wait for it
+            server['cache_entries'] = len(cache.entries())
+            server['info'] = {
+                'datasets': get_datasets_info(),
+                'classifiers': get_classifier_info(),
+                'projections': projection.info()
+            }
+            server['ready'] = True
+            server['error'] = None
+            cprint(f'Server initialized in {time() - t0:.2f}s, '
+                   f'{server["cache_entries"]} cached files', 'green')
+        except Exception as e:
+            server['error'] = str(e)
+            cprint(f'Server initialization failed: {e}', 'red')
+            raise
+
+
+@app.before_request
+def before_request():
+    # the health check reports failed initialization instead of raising
+    if request.path != '/health':
+        init_server()
+
+
+@app.route('/health', methods=('get',))
+def health():
+    if not server['ready'] and server['error'] is None:
+        try:
+            init_server()
+        except Exception:
+            pass
+    response = jsonify({
+        'type': 'health',
+        'ready': server['ready'],
+        'error': server['error'],
+        'uptime': time() - server['started'],
+        'cache_path': cache_path,
+        'cache_entries': server.get('cache_entries'),
+        'memory_cache': cache.memory_cache_info()
+    })
+    if not server['ready']:
+        response.status_code = 503
+    return response
+
+
+def get_etag(args, files):
+    """
+    Returns an entity tag for a response that only depends on
+    cached files, it changes when one of them is written again.
+    """
+    return tools.hash({
+        'action': args['action'],
+        'format': args.get('format', 'json'),
+        'decimals': json_float_decimals,
+        'version': cache.get_version(files)
+    })
+
+
+def is_not_modified(etag):
+    """
+    Returns whether the client already has the response with this tag.
+    Tags of compressed responses have the encoding appended.
+    """
+    if request.if_none_match.star_tag:
+        return True
+    return any(tag.split('-')[0] == etag
+               for tag in request.if_none_match.as_set())
+
+
+def set_cache_headers(response, etag, immutable, encoding):
+    if etag is None:
+        return
+    response.set_etag(etag if encoding is None else f'{etag}-{encoding}')
+    # clients must ask again, unless the content can never change
+    response.headers['Cache-Control'] = \
+        'public, max-age=31536000, immutable' if immutable else 'no-cache'
+
+
+def not_modified(etag, immutable=False):
+    """
+    Returns an empty response telling the client to use its copy.
+    """
+    cprint('  Not modified', 'green')
+    encoding = None
+    if compress_responses:
+        encoding = transport.get_encoding(
+            request.headers.get('Accept-Encoding', ''))
+    response = Response(status=304)
+    set_cache_headers(response, etag, immutable, encoding)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def serialize(args, data):
+    """
+    Returns the response body in the requested format and its mimetype.
+    """
+    if args.get('format', 'json') == 'binary':
+        return transport.encode(data), transport.MIME_TYPE
+    return transport.encode_json(data, decimals=json_float_decimals), \
+        'application/json'
+
+
+def send_stored(args, filename, etag, immutable=False):
+    """
+    Sends the serialized content of a cached file. The response body is
+    stored next to the file the first time (for each encoding), later
+    requests send the stored body without reading or serializing the file.
+
+    Keyword arguments:
+    - args: request arguments
+    - filename: name of the cached file
+    - etag: entity tag of the response, see get_etag(), it is part of the
+        stored file's name, so another format or precision is stored separately
+    - immutable: see send()
+    """
+    encoding = None
+    if compress_responses:
+        encoding = transport.get_encoding(
+            request.headers.get('Accept-Encoding', ''))
+    # bodies of the current version of the file start with this
+    version = f'{filename}_response_{cache.get_version([filename])}_'
+    stored = f'{version}{etag}'
+    mimetype = transport.MIME_TYPE \
+        if args.get('format', 'json') == 'binary' else 'application/json'
+
+    if encoding is not None and cache.contains(f'{stored}.{encoding}'):
+        stored = f'{stored}.{encoding}'
+    elif cache.contains(stored) and (encoding is None or os.path.getsize(
+            cache.get_path(stored)) < transport.MIN_COMPRESS_SIZE):
+        # small bodies are not compressed
+        encoding = None
+    else:
+        # remove bodies of older versions of the file
+        for f in cache.entries(prefix=f'{filename}_response_'):
+            if not f.startswith(version):
+                cache.delete(f)
+        t0 = perf_counter()
+        if cache.contains(stored):
+            body = Path(cache.get_path(stored)).read_bytes()
+        else:
+            body, mimetype = serialize(args, cache.read(filename))
+            cache.write_bytes(stored, body)
+        if encoding is not None and len(body) >= transport.MIN_COMPRESS_SIZE:
+            stored = f'{stored}.{encoding}'
+            cache.write_bytes(stored, transport.compress(
+                body, encoding, compression_level))
+        else:
+            encoding = None
+        print(f'  Stored response in {perf_counter() - t0:.3f}s')
+
+    # the WSGI server may send the file with sendfile() without copying it
+    path = cache.get_path(stored)
+    response = Response(wrap_file(request.environ, open(path, 'rb')),
+                        mimetype=mimetype, direct_passthrough=True)
+    response.content_length = os.path.getsize(path)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    set_cache_headers(response, etag, immutable, encoding)
+    return response
+
+
+def send(args, data, etag=None, immutable=False, etag_from_body=False):
+    """
+    Sends data in the format requested by the client, JSON by default,
+    see modules/transport.py for the binary format.
+
+    Keyword arguments:
+    - args: request arguments
+    - data: data to send
+    - etag: entity tag of the response, see get_etag()
+    - immutable: if True, clients may keep the response forever
+    - etag_from_body: if True and no etag is given,
+        the tag is computed from the response body
+    """
+    # JSONP requests get the JSON wrapped into a call like in
+    # flask_jsonpify, but encoded with transport to support arrays
+    if request.args.get('callback'):
+        body = transport.encode_json(data, decimals=json_float_decimals)
+        callback = request.args['callback'].encode('utf-8')
+        return Response(callback + b'(' + body + b');',
+                        mimetype='application/javascript')
+    t0 = perf_counter()
+    body, mimetype = serialize(args, data)
+    t1 = perf_counter()
+
+    # the body is still sent to the client, but it can skip parsing it
+    if etag is None and etag_from_body:
+        etag = md5(body).hexdigest()
+        if is_not_modified(etag):
+            return not_modified(etag, immutable)
+
+    encoding = None
+    if compress_responses and len(body) >= transport.MIN_COMPRESS_SIZE:
+        encoding = transport.get_encoding(
+            request.headers.get('Accept-Encoding', ''))
+    size = len(body)
+    if encoding is not None:
+        body = transport.compress(body, encoding, compression_level)
+    print(f'  Serialized {size / 2**20:.2f} MB in {t1 - t0:.3f}s'
+          + (f', {encoding} {len(body) / 2**20:.2f} MB '
+             f'in {perf_counter() - t1:.3f}s' if encoding else ''))
+
+    response = Response(body, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    set_cache_headers(response, etag, immutable, encoding)
+    return response
+
 
 @app.route('/', methods=('get', 'post'))
 def rest():
-    # initialize server
-    cache.init(cache_path, log_actions=log_cache_actions)
     cprint('─' * 80, 'cyan')
 
     # parse JSON args
@@ -74,6 +325,8 @@ def rest():
                    'info')
         action = args['action']
         tools.check_arg('action', action, str, actions)
+        tools.check_arg('format', args.get('format', 'json'),
+                        str, transport.FORMATS)
     except:
         cprint('Invalid or no arguments, sending error.', 'red')
         return jsonify({
@@ -98,6 +351,9 @@ def rest():
                     cache.delete(f)
                 except:
                     errors.append(f)
+            # remove the predictions of deleted classifiers
+            for data_hash in set(f.split('__')[0] for f in args['files']):
+                prediction_store.compact(data_hash)
             if len(errors) == 0:
                 return jsonpify({
                     'type': 'success',
@@ -111,11 +367,14 @@ def rest():
                 })
 
         elif action == 'delete_all_clf_projs':
-            return jsonpify(cache.delete_all_clf_projs())
+            return send(args, cache.delete_all_clf_projs())
 
         elif action == 'cache_content':
             cprint('Sending cache content', 'green')
-            return jsonpify(cache.content())
+            return send(args, cache.content(data_hash=args.get('data_hash'),
+                                            offset=args.get('offset', 0),
+                                            limit=args.get('limit'),
+                                            since=args.get('since')))
 
         # server info
         elif action == 'info':
@@ -124,34 +383,55 @@ def rest():
                 'type': 'info',
                 'msg': 'Information on available plugins etc.',
                 'actions': actions,
-                'datasets': get_datasets_info(),
-                'classifiers': get_classifier_info(),
-                'projections': projection.info()
+                'datasets': server['info']['datasets'],
+                'classifiers': server['info']['classifiers'],
+                'projections': server['info']['projections'],
+                'memory_cache': cache.memory_cache_info()
             })
 
         # classifier projection with all possible parameters
         # this is fast compared to loading clfs from cache every time
         elif action == 'batch_project_classifiers':
             projs = projection.batch_project_classifiers(args)
-            return jsonpify(projs)
+            return send(args, projs, etag_from_body=True)
 
         # all classifications at once
         elif action == 'get_clf_results':
             files = args['files']
+            etag = get_etag(args, files)
+            if is_not_modified(etag):
+                return not_modified(etag)
             cprint('Sending classification results', 'green')
-            results, success_files, errors = cache.read_multiple(files)
-            return jsonpify({
+            timings = {}
+            results, success_files, errors = cache.read_multiple(
+                files, n_threads=read_threads, timings=timings)
+            print(f'  Read {timings["files"]} files with '
+                  f'{timings["threads"]} threads in {timings["wall"]:.3f}s '
+                  f'(sum {timings["read"]:.3f}s, '
+                  f'slowest {timings["slowest"]:.3f}s)')
+            return send(args, {
                 'files': success_files,
                 'classifiers': results,
                 'errors': errors
-            })
+            }, etag=etag)
 
         # data projection
         elif action == 'project':
             proj_args = args['projection']
-            if 'file' in proj_args and proj_args['file'] in cache.entries():
+            if 'file' in proj_args and cache.contains(proj_args['file']):
+                # projections are named by the hash of their arguments
+                # and never change, so clients may keep them
+                etag = get_etag(args, [proj_args['file']])
+                if is_not_modified(etag):
+                    return not_modified(etag, immutable=True)
                 cprint('Sending projected data', 'green')
-                return jsonpify(cache.read(proj_args['file']))
+                if store_responses and not request.args.get('callback'):
+                    return send_stored(args, proj_args['file'], etag,
+                                       immutable=True)
+                # compactly stored coordinates are encoded without
+                # converting them to lists first
+                return send(args, cache.read(proj_args['file']),
+                            etag=etag, immutable=True)
             else:
                 cprint('Projection is missing!', 'red')
                 print(json.dumps(proj_args, sort_keys=False, indent=4))
@@ -173,6 +453,7 @@ def rest():
 
 # start server when program starts
 if __name__ == '__main__':
+    init_server()
     cprint('Server is running at http://{}:{}/\n'.format(host, port), 'green')
     if not debug:
         cprint(
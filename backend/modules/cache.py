@@ -1,35 +1,532 @@
-from os import listdir, remove, makedirs
-from os.path import isfile, join, exists
+from os import listdir, remove, makedirs, replace, getpid, kill, stat
+from os.path import isfile, join, exists, getsize
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import shutil
+import tempfile
+from time import perf_counter
 import joblib
+import joblib.compressor
 from termcolor import cprint
 import json
 from pathlib import Path
+import sqlite3
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+import numpy as np
+from . import tools
 
+try:
+    import fcntl
+except ImportError:
+    # file locking is not available on Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ARRAY_FORMATS = ('pickle', 'npy', 'columnar')
+
+# precision for storing probabilities and projected coordinates,
+# uint8 quantizes probabilities to 256 levels (coordinates use float16)
+PRECISIONS = ('float64', 'float32', 'float16', 'uint8')
+
+# compression of pickled files, see joblib.dump(),
+# zlib and lzma are always available, lz4 needs the lz4 package,
+# zstd the zstandard package
+CODECS = ('none', 'zlib', 'lz4', 'lzma', 'zstd')
+
+# first bytes of files written with each codec
+_CODEC_MAGIC = {
+    'zlib': b'\x78',
+    'lz4': b'\x04\x22\x4d\x18',
+    'lzma': b'\x5d\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'none': b'\x80'
+}
+
+
+class _ZstdCompressorWrapper(joblib.compressor.CompressorWrapper):
+    """
+    Lets joblib.dump() and joblib.load() use zstd, which joblib
+    does not support itself.
+    """
+
+    def __init__(self):
+        super().__init__(obj=None, prefix=_CODEC_MAGIC['zstd'],
+                         extension='.zst')
+
+    def compressor_file(self, fileobj, compresslevel=None):
+        # joblib.dump() passes the file name when dumping to a path
+        if isinstance(fileobj, str):
+            fileobj = open(fileobj, 'wb')
+        compressor = zstandard.ZstdCompressor(level=compresslevel or 3)
+        return compressor.stream_writer(fileobj)
+
+    def decompressor_file(self, fileobj):
+        if isinstance(fileobj, str):
+            fileobj = open(fileobj, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+if zstandard is not None:
+    joblib.register_compressor('zstd', _ZstdCompressorWrapper(), force=True)
+
+# dtypes that are kept as arrays in the pickle format,
+# as lists would not preserve them
+COMPACT_DTYPES = (np.float32, np.float16, np.uint8, np.uint16)
+
+# SQLite database inside the cache directory that lists all cached files
+INDEX_FILE = '.index.sqlite'
+
+# directory inside the cache directory with one lock file per key
+LOCK_DIR = '.locks'
 
 _cache_path = None
 _log_actions = True
+_array_format = 'pickle'
+_precision = 'float64'
+_codec = 'none'
+_codec_level = 3
+_index = None
+_index_path = None
+_index_lock = threading.RLock()
+
+# in-memory cache of unpickled files for read(),
+# {path: (modification time, size in bytes, data)}, least recently used first
+_memory_cache = OrderedDict()
+_memory_cache_size = 0
+_memory_cache_max = 0
+_memory_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_memory_cache_lock = threading.Lock()
 
+# threads of read_multiple(), kept for later calls
+_read_executor = None
+_read_executor_threads = 0
 
-def init(cache_path, log_actions=True):
+
+def init(cache_path, log_actions=True, array_format='pickle', precision='float64',
+         codec='none', codec_level=3, memory_cache_size=0):
     """
     Initializes the cache.
 
     Keyword Arguments:
     - cache_path: directory where cached files are saved
     - log_actions: when true, all actions are logged
+    - array_format: how write_arrays() stores arrays, one of
+        pickle (a single pickled file with lists),
+        npy (one .npy file per array, read memory-mapped) or
+        columnar (like npy, but classifier predictions are appended to
+        one matrix per dataset, see prediction_store.py)
+    - precision: how probabilities and projected coordinates are stored,
+        one of PRECISIONS, predicted labels are stored with the smallest
+        unsigned integer type for the number of classes unless it is float64
+    - codec: compression of pickled files, one of CODECS,
+        files written with other codecs can always be read
+    - codec_level: compression level from 1 (fastest) to 9 (smallest)
+    - memory_cache_size: MB of unpickled files that read() keeps in memory,
+        0 disables it, objects returned by read() must then not be modified
     """
-    global _cache_path, _log_actions
+    global _cache_path, _log_actions, _array_format, _precision, \
+        _codec, _codec_level, _memory_cache_max
+    if array_format not in ARRAY_FORMATS:
+        raise Exception(
+            f'Invalid cache array format "{array_format}", must be in {ARRAY_FORMATS}')
+    if precision not in PRECISIONS:
+        raise Exception(
+            f'Invalid cache precision "{precision}", must be in {PRECISIONS}')
+    check_codec(codec)
+    tools.check_arg('codec_level', codec_level, int, (1, 9))
     _log_actions = log_actions
     _cache_path = cache_path
+    _array_format = array_format
+    _precision = precision
+    _codec = codec
+    _codec_level = codec_level
+    with _memory_cache_lock:
+        _memory_cache_max = memory_cache_size * 2**20
+        _evict_from_memory()
 
     try:
         if not exists(cache_path):
             makedirs(cache_path)
+        _open_index()
     except Exception as e:
         cprint(e, 'red')
 
 
+def check_codec(codec):
+    """
+    Raises an exception if a codec is invalid or not installed.
+    """
+    if codec not in CODECS:
+        raise Exception(
+            f'Invalid cache codec "{codec}", must be in {CODECS}')
+    if codec == 'lz4':
+        try:
+            import lz4
+        except ImportError:
+            raise Exception(
+                'Cache codec lz4 needs the lz4 package (pip install lz4)')
+    if codec == 'zstd' and zstandard is None:
+        raise Exception(
+            'Cache codec zstd needs the zstandard package (pip install zstandard)')
+
+
+def _open_index():
+    """
+    Opens the index of the current cache directory, creates it from
+    the directory's content if it does not exist yet.
+    """
+    global _index, _index_path
+    with _index_lock:
+        path = join(_cache_path, INDEX_FILE)
+        if _index is not None and _index_path == path:
+            return _index
+        if _index is not None:
+            _index.close()
+        if not exists(_cache_path):
+            makedirs(_cache_path)
+        is_new = not exists(path)
+        _index = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        _index_path = path
+        has_metadata = _index.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+            ('table', 'metadata')).fetchone() is not None
+        _index.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'name TEXT PRIMARY KEY, '
+                       'data_hash TEXT, '
+                       'entry_type TEXT)')
+        _index.execute('CREATE INDEX IF NOT EXISTS entries_by_type '
+                       'ON entries (data_hash, entry_type)')
+        # codec of pickled files, added to older indexes
+        columns = [row[1] for row in _index.execute(
+            'PRAGMA table_info(entries)')]
+        if 'codec' not in columns:
+            _index.execute('ALTER TABLE entries ADD COLUMN codec TEXT')
+        # args and scores of all entries for content(),
+        # seq increases with every change to allow incremental updates
+        _index.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                       'file TEXT PRIMARY KEY, '
+                       'data_hash TEXT, '
+                       'entry_type TEXT, '
+                       'args TEXT, '
+                       'scores TEXT, '
+                       'seq INTEGER, '
+                       'deleted INTEGER DEFAULT 0)')
+        _index.execute('CREATE INDEX IF NOT EXISTS metadata_by_seq '
+                       'ON metadata (seq)')
+        _index.execute('CREATE INDEX IF NOT EXISTS metadata_by_data_hash '
+                       'ON metadata (data_hash, seq)')
+        # seq starts again when the metadata is rebuilt or the cache is
+        # cleared, the epoch changes then, so tokens of content() with
+        # an old epoch can be detected
+        _index.execute('CREATE TABLE IF NOT EXISTS settings ('
+                       'key TEXT PRIMARY KEY, '
+                       'value TEXT)')
+        _index.execute('INSERT OR IGNORE INTO settings VALUES (?, ?)',
+                       ('epoch', uuid.uuid4().hex))
+        _index.commit()
+        if is_new:
+            rebuild_index()
+        elif not has_metadata:
+            _rebuild_metadata()
+        return _index
+
+
+def _entry_type(filename):
+    """
+    Returns the type of a cache entry based on its file name.
+    """
+    if '__clf_proj_' in filename:
+        return 'clf_proj'
+    if '__clf_' in filename:
+        return 'clf'
+    if '__proj_' in filename:
+        return 'proj'
+    if '__preds_' in filename:
+        return 'preds'
+    if filename.startswith('data_'):
+        return 'data'
+    return 'other'
+
+
+def _detect_codec(filename):
+    """
+    Returns the codec of a pickled file or None if it is not pickled.
+    """
+    if filename.endswith(('.json', '.npy', '.bin')) \
+            or _entry_type(filename) == 'preds':
+        return None
+    try:
+        with open(join(_cache_path, filename), 'rb') as f:
+            head = f.read(8)
+    except OSError:
+        return None
+    for codec, magic in _CODEC_MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def _data_hash(filename):
+    """
+    Returns the hash of the dataset a cache entry belongs to.
+    """
+    if filename.startswith('data_'):
+        return filename.split('__')[0].split('_args.json')[0]
+    return None
+
+
+def add_to_index(filenames, codec=None):
+    """
+    Adds files to the index, must be called for all files that are
+    written to the cache directory without using this module.
+
+    Keyword Arguments:
+    - filenames: a file name or a list of them
+    - codec: codec of pickled files or None if unknown
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    rows = [(f, _data_hash(f), _entry_type(f), codec) for f in filenames]
+    with _index_lock:
+        index = _open_index()
+        index.executemany(
+            'INSERT OR REPLACE INTO entries (name, data_hash, entry_type, codec) '
+            'VALUES (?, ?, ?, ?)', rows)
+        index.commit()
+
+
+def _remove_from_index(filenames):
+    with _index_lock:
+        index = _open_index()
+        index.execute('BEGIN IMMEDIATE')
+        index.executemany('DELETE FROM entries WHERE name = ?',
+                          [(f,) for f in filenames])
+        # keep deleted entries' metadata, so clients can be notified,
+        # each entry gets its own seq, content() pages by seq
+        seq = _next_seq(index)
+        args_files = [f for f in filenames if f.endswith('_args.json')]
+        index.executemany('UPDATE metadata SET deleted = 1, seq = ? '
+                          'WHERE file = ?',
+                          [(seq + i, f) for i, f in enumerate(args_files)])
+        index.commit()
+
+
+def _next_seq(index):
+    return index.execute(
+        'SELECT COALESCE(MAX(seq), 0) + 1 FROM metadata').fetchone()[0]
+
+
+def _update_metadata(filename, data):
+    """
+    Stores the content of _args.json and _scores.json files in the index.
+    """
+    if filename.endswith('_args.json'):
+        column = 'args'
+        args_file = filename
+    elif filename.endswith('_scores.json'):
+        column = 'scores'
+        args_file = filename.replace('_scores.json', '_args.json')
+    else:
+        return
+    with _index_lock:
+        index = _open_index()
+        # lock the database, so no other process can use the same seq
+        index.execute('BEGIN IMMEDIATE')
+        index.execute('INSERT OR IGNORE INTO metadata '
+                      '(file, data_hash, entry_type) VALUES (?, ?, ?)',
+                      (args_file, _data_hash(args_file), _entry_type(args_file)))
+        index.execute(f'UPDATE metadata SET {column} = ?, seq = ?, deleted = 0 '
+                      'WHERE file = ?',
+                      (json.dumps(data), _next_seq(index), args_file))
+        index.commit()
+
+
+def _rebuild_metadata():
+    """
+    Reads all _args.json and _scores.json files into the index.
+    """
+    with _index_lock:
+        index = _open_index()
+        index.execute('DELETE FROM metadata')
+        index.execute('UPDATE settings SET value = ? WHERE key = ?',
+                      (uuid.uuid4().hex, 'epoch'))
+        index.commit()
+        for f in entries():
+            if f.endswith('_args.json') or f.endswith('_scores.json'):
+                try:
+                    contents = Path(join(_cache_path, f)).read_text()
+                    _update_metadata(f, json.loads(contents))
+                except Exception as e:
+                    cprint(f'Cannot read {f}', 'red')
+                    cprint(e, 'red')
+
+
+def rebuild_index():
+    """
+    Rebuilds the index from the content of the cache directory.
+    Needed when files have been copied into or removed from the
+    cache directory by hand.
+
+    Returns:
+    - number of files in the index
+    """
+    cprint('Rebuilding cache index', 'yellow')
+    _remove_temporary_files()
+    filenames = [f for f in listdir(_cache_path)
+                 if not f.startswith('.') and isfile(join(_cache_path, f))]
+    with _index_lock:
+        index = _open_index()
+        index.execute('DELETE FROM entries')
+        index.commit()
+        by_codec = {}
+        for f in filenames:
+            by_codec.setdefault(_detect_codec(f), []).append(f)
+        for codec, files in by_codec.items():
+            add_to_index(files, codec)
+        _rebuild_metadata()
+    cprint(f'Indexed {len(filenames)} files', 'green')
+    return len(filenames)
+
+
+def _remove_temporary_files():
+    """
+    Removes temporary files left by processes that were killed while
+    writing to the cache, see _atomic_file().
+    """
+    for f in listdir(_cache_path):
+        if not (f.startswith('.') and f.endswith('.tmp')):
+            continue
+        try:
+            pid = int(f.split('.')[-2])
+            # raises an exception if the process does not exist
+            kill(pid, 0)
+        except ProcessLookupError:
+            remove(join(_cache_path, f))
+        except (ValueError, OSError):
+            pass
+
+
+def get_init_args():
+    """
+    Returns the arguments given to init(),
+    e.g. to initialize the cache in another process.
+    """
+    return {
+        'cache_path': _cache_path,
+        'log_actions': _log_actions,
+        'array_format': _array_format,
+        'precision': _precision,
+        'codec': _codec,
+        'codec_level': _codec_level,
+        'memory_cache_size': _memory_cache_max // 2**20
+    }
+
+
+def get_path(filename):
+    """
+    Returns the path of a file in the cache.
+    """
+    return join(_cache_path, filename)
+
+
+def get_array_format():
+    """
+    Returns the array format given in init().
+    """
+    return _array_format
+
+
+@contextmanager
+def _atomic_file(filename):
+    """
+    Yields a temporary path to write a cache file to, which replaces
+    the file when the block ends without an exception.
+    Readers therefore see either the old or the complete new file,
+    but never a partially written one.
+    """
+    # temporary files start with a dot, so the index ignores them,
+    # the name is unique, since threads may write the same file
+    tmp_path = join(_cache_path,
+                    f'.{filename}.{uuid.uuid4().hex}.{getpid()}.tmp')
+    try:
+        yield tmp_path
+        replace(tmp_path, join(_cache_path, filename))
+    finally:
+        if exists(tmp_path):
+            remove(tmp_path)
+
+
+@contextmanager
+def lock(filename, blocking=True, shared=False):
+    """
+    Advisory lock for producing a cache entry, shared by all
+    processes that use the same cache directory.
+    Locks are released when the block ends or the process dies.
+
+    Keyword Arguments:
+    - filename: name of the cache entry
+    - blocking: if False, do not wait for another process
+    - shared: if True, other shared locks may be held at the same time
+        (e.g. by readers), but no exclusive lock
+
+    Yields:
+    - True if the lock is held, False if another process holds it
+        (only when not blocking)
+    """
+    if fcntl is None:
+        yield True
+        return
+    lock_dir = join(_cache_path, LOCK_DIR)
+    makedirs(lock_dir, exist_ok=True)
+    with open(join(lock_dir, f'{filename}.lock'), 'a+') as f:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            if not shared:
+                # the process that is producing the entry, for debugging
+                f.truncate(0)
+                f.write(str(getpid()))
+                f.flush()
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def claim(filename):
+    """
+    Marks a cache entry as in progress, so other processes can skip it
+    instead of producing it a second time. Use it as context manager,
+    it yields False if another process has already claimed the entry:
+
+        with cache.claim(clf_cache) as claimed:
+            if claimed and not cache.contains(clf_cache):
+                ...
+    """
+    return lock(filename, blocking=False)
+
+
+def in_progress(filename):
+    """
+    Returns whether another process has claimed a cache entry.
+    """
+    with claim(filename) as claimed:
+        return not claimed
+
+
 def write(filename, data):
     """
     Pickles a file and writes it to the cache.
@@ -40,7 +537,110 @@ def write(filename, data):
     """
     if _log_actions:
         cprint('Writing to cache: "{}"'.format(filename), 'green')
-    joblib.dump(data, join(_cache_path, filename))
+    with _atomic_file(filename) as path:
+        dump(data, path, _codec, _codec_level)
+    add_to_index(filename, _codec)
+    _remove_from_memory([filename])
+
+
+def dump(data, path, codec, level=3):
+    """
+    Pickles data to a file with a codec from CODECS.
+    joblib stores the codec in the file, so joblib.load() can read
+    files with any codec.
+    """
+    compress = 0 if codec == 'none' else (codec, level)
+    joblib.dump(data, path, compress=compress)
+
+
+def codecs():
+    """
+    Returns the number of indexed files for each codec,
+    files that have been indexed without writing them are counted as None.
+    """
+    with _index_lock:
+        index = _open_index()
+        return dict(index.execute(
+            'SELECT codec, COUNT(*) FROM entries GROUP BY codec').fetchall())
+
+
+def benchmark_codecs(codecs=CODECS, level=3, max_files=20):
+    """
+    Measures how fast and how well each codec compresses the pickled
+    files of the cache, the cache itself is not changed.
+
+    Keyword Arguments:
+    - codecs: codecs to compare, codecs that are not installed are skipped
+    - level: compression level
+    - max_files: number of files to use, the largest files are used first
+
+    Returns:
+    - list of dicts with codec, files, raw size and size in MB,
+        ratio (raw size / size), write and read throughput in MB/s
+        of uncompressed data
+    """
+    with _index_lock:
+        index = _open_index()
+        filenames = [row[0] for row in index.execute(
+            'SELECT name FROM entries WHERE codec IS NOT NULL')]
+    filenames = sorted(filenames, key=lambda f: getsize(get_path(f)),
+                       reverse=True)[:max_files]
+    results = []
+    if len(filenames) == 0:
+        return results
+
+    directory = tempfile.mkdtemp(prefix='clavis_codecs_')
+    try:
+        data = [joblib.load(get_path(f)) for f in filenames]
+        # the uncompressed size is the reference for all codecs
+        raw_size = 0
+        for i, d in enumerate(data):
+            path = join(directory, f'raw_{i}')
+            dump(d, path, 'none')
+            raw_size += getsize(path)
+            remove(path)
+
+        for codec in codecs:
+            try:
+                check_codec(codec)
+            except Exception as e:
+                cprint(e, 'red')
+                continue
+            size = write_time = read_time = 0
+            for i, d in enumerate(data):
+                path = join(directory, f'{codec}_{i}')
+                t0 = perf_counter()
+                dump(d, path, codec, level)
+                write_time += perf_counter() - t0
+                size += getsize(path)
+                t0 = perf_counter()
+                joblib.load(path)
+                read_time += perf_counter() - t0
+                remove(path)
+            mb = raw_size / 2**20
+            results.append({
+                'codec': codec,
+                'files': len(data),
+                'raw_size': mb,
+                'size': size / 2**20,
+                'ratio': raw_size / max(size, 1),
+                'write': mb / max(write_time, 1e-9),
+                'read': mb / max(read_time, 1e-9)
+            })
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def write_bytes(filename, data):
+    """
+    Writes bytes to a file, e.g. a serialized response.
+    """
+    if _log_actions:
+        cprint('Writing to cache (bytes): "{}"'.format(filename), 'green')
+    with _atomic_file(filename) as path:
+        Path(path).write_bytes(data)
+    add_to_index(filename)
 
 
 def write_plain(filename, data, add_extension=True):
@@ -51,8 +651,9 @@ def write_plain(filename, data, add_extension=True):
         cprint('Writing to cache (plain): "{}"'.format(filename), 'green')
     if add_extension:
         filename += '.json'
-    with open(join(_cache_path, filename), 'w') as f:
-        f.write(data)
+    with _atomic_file(filename) as path:
+        Path(path).write_text(data)
+    add_to_index(filename)
 
 
 def write_dict_json(filename, data, add_extension=True):
@@ -64,8 +665,10 @@ def write_dict_json(filename, data, add_extension=True):
     json_string = json.dumps(data, sort_keys=False, indent=4)
     if add_extension:
         filename += '.json'
-    with open(join(_cache_path, filename), 'w') as f:
-        f.write(json_string)
+    with _atomic_file(filename) as path:
+        Path(path).write_text(json_string)
+    add_to_index(filename)
+    _update_metadata(filename, data)
 
 
 def read(filename):
@@ -78,37 +681,332 @@ def read(filename):
     Returns:
     - data: unpickled object
     """
+    global _memory_cache_size
     if _log_actions:
         cprint('Loading from cache: "{}"'.format(filename), 'green')
-    return joblib.load(join(_cache_path, filename))
+    path = join(_cache_path, filename)
+    if _memory_cache_max == 0:
+        return joblib.load(path)
+
+    # files are replaced when they are written again,
+    # so a new modification time means the cached data is outdated
+    mtime = stat(path).st_mtime_ns
+    with _memory_cache_lock:
+        entry = _memory_cache.get(path)
+        if entry is not None and entry[0] == mtime:
+            _memory_cache.move_to_end(path)
+            _memory_cache_stats['hits'] += 1
+            return entry[2]
+        _memory_cache_stats['misses'] += 1
+
+    data = joblib.load(path)
+    size = _estimate_size(data)
+    with _memory_cache_lock:
+        if path in _memory_cache:
+            _memory_cache_size -= _memory_cache.pop(path)[1]
+        if size <= _memory_cache_max:
+            _memory_cache[path] = (mtime, size, data)
+            _memory_cache_size += size
+            _evict_from_memory()
+    return data
+
+
+def _estimate_size(data):
+    """
+    Returns the approximate memory used by unpickled data in bytes.
+    """
+    if isinstance(data, np.ndarray):
+        return sys.getsizeof(data) + (data.nbytes if data.base is None else 0)
+    if isinstance(data, dict):
+        return sys.getsizeof(data) + sum(
+            _estimate_size(k) + _estimate_size(v) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        size = sys.getsizeof(data)
+        if len(data) > 0 and isinstance(data[0], (int, float)):
+            # lists of numbers (e.g. coordinates) are not walked item by item
+            return size + len(data) * sys.getsizeof(data[0])
+        return size + sum(_estimate_size(v) for v in data)
+    return sys.getsizeof(data)
+
+
+def _evict_from_memory():
+    """
+    Removes the least recently used files from the memory cache until
+    it fits its size, must be called with _memory_cache_lock held.
+    """
+    global _memory_cache_size
+    while len(_memory_cache) > 0 and _memory_cache_size > _memory_cache_max:
+        _, (_, size, _) = _memory_cache.popitem(last=False)
+        _memory_cache_size -= size
+        _memory_cache_stats['evictions'] += 1
+
+
+def _remove_from_memory(filenames=None):
+    """
+    Removes files from the memory cache, all files if filenames is None.
+    """
+    global _memory_cache_size
+    with _memory_cache_lock:
+        if filenames is None:
+            _memory_cache.clear()
+            _memory_cache_size = 0
+            return
+        for f in filenames:
+            entry = _memory_cache.pop(join(_cache_path, f), None)
+            if entry is not None:
+                _memory_cache_size -= entry[1]
+
+
+def memory_cache_info():
+    """
+    Returns the state of the memory cache of read():
+    number of files, size and maximum size in MB,
+    hits, misses and evictions since the server started.
+    """
+    with _memory_cache_lock:
+        return dict(_memory_cache_stats,
+                    files=len(_memory_cache),
+                    size=_memory_cache_size / 2**20,
+                    max_size=_memory_cache_max / 2**20)
+
+
+def get_version(filenames):
+    """
+    Returns a hash that changes whenever one of the files is written,
+    deleted or created, e.g. to validate copies of them.
+    """
+    versions = []
+    for f in filenames:
+        try:
+            versions.append(f'{f}:{stat(join(_cache_path, f)).st_mtime_ns}')
+        except OSError:
+            versions.append(f'{f}:missing')
+    return tools.hash(versions)
+
+
+def get_precision():
+    """
+    Returns the precision given in init().
+    """
+    return _precision
 
 
-def read_multiple(filenames):
+def compact_probabilities(array):
+    """
+    Returns probabilities in the precision given in init(),
+    see expand_probabilities() for the inverse.
+    """
+    if array is None or _precision == 'float64':
+        return array
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating):
+        return array
+    if _precision == 'uint8':
+        return np.round(np.clip(array, 0, 1) * 255).astype(np.uint8)
+    return array.astype(_precision)
+
+
+def expand_probabilities(array):
+    """
+    Returns probabilities that have been stored with
+    compact_probabilities() as float32 or float64 array,
+    other values are returned unchanged.
+    """
+    if not isinstance(array, np.ndarray):
+        return array
+    if array.dtype == np.uint8:
+        return array.astype(np.float32) / 255
+    if array.dtype == np.float16:
+        return array.astype(np.float32)
+    return array
+
+
+def compact_labels(array, num_classes):
+    """
+    Returns integer labels with the smallest unsigned type for
+    num_classes, unless the precision given in init() is float64.
+    Labels that do not fit are returned unchanged.
+    """
+    if array is None or _precision == 'float64':
+        return array
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.integer) or array.size == 0:
+        return array
+    # multi-label data uses 0 and 1 for each class
+    n = max(num_classes, 2)
+    if array.min() < 0 or array.max() >= n or n > 2**16:
+        return array
+    return array.astype(np.uint8 if n <= 2**8 else np.uint16)
+
+
+def expand_labels(array):
+    """
+    Returns labels that have been stored with compact_labels()
+    as int64 array, other values are returned unchanged.
+    """
+    if isinstance(array, np.ndarray) and array.dtype in (np.uint8, np.uint16):
+        return array.astype(np.int64)
+    return array
+
+
+def compact_coordinates(array):
+    """
+    Returns projected coordinates in the precision given in init(),
+    as list for float64 (like in older caches), otherwise as array.
+    """
+    if _precision == 'float64':
+        return tools.tolist(array)
+    dtype = np.float16 if _precision == 'uint8' else _precision
+    return np.asarray(array).astype(dtype)
+
+
+def _to_pickle(value):
+    # compact arrays are kept, since lists do not preserve their dtype
+    if isinstance(value, np.ndarray) and value.dtype in COMPACT_DTYPES:
+        return value
+    return tools.tolist(value)
+
+
+def write_arrays(filename, arrays):
+    """
+    Writes a dictionary of arrays to the cache, using the
+    array format given in init().
+
+    Keyword Arguments:
+    - filename: name of the file (or prefix of the .npy files) to write to
+    - arrays: dictionary {name: array}, values may be None
+    """
+    if _array_format == 'pickle':
+        write(filename, {k: _to_pickle(v) for k, v in arrays.items()})
+        return
+
+    if _log_actions:
+        cprint('Writing to cache (npy): "{}"'.format(filename), 'green')
+    written = []
+    for key, value in arrays.items():
+        # None values are not written and read as None
+        if value is not None:
+            array_file = _array_filename(filename, key)
+            with _atomic_file(array_file) as path:
+                with open(path, 'wb') as f:
+                    np.save(f, np.asarray(value))
+            written.append(array_file)
+    add_to_index(written)
+
+
+def read_arrays(filename, keys):
+    """
+    Reads a dictionary of arrays that has been written with write_arrays().
+    Both array formats can be read, regardless of the current setting.
+    Arrays in the npy format are memory-mapped and not loaded into memory
+    until they are accessed.
+
+    Keyword Arguments:
+    - filename: name of the file (or prefix of the .npy files) to read
+    - keys: names of the arrays to read
+
+    Returns:
+    - dictionary {name: array}, missing arrays are None
+    """
+    if contains(filename):
+        return read(filename)
+
+    if _log_actions:
+        cprint('Loading from cache (npy): "{}"'.format(filename), 'green')
+    arrays = {}
+    for key in keys:
+        path = join(_cache_path, _array_filename(filename, key))
+        if not exists(path):
+            arrays[key] = None
+            continue
+        try:
+            arrays[key] = np.load(path, mmap_mode='r')
+        except ValueError:
+            # arrays of Python objects cannot be memory-mapped
+            arrays[key] = np.load(path, allow_pickle=True)
+    return arrays
+
+
+def _array_filename(filename, key):
+    return f'{filename}.{key}.npy'
+
+
+def read_multiple(filenames, n_threads=1, timings=None):
     """
     Reads multiple file from the cache and unpickles them.
 
     Keyword Arguments:
     - filenames: names of the files to read
+    - n_threads: number of files that are read at the same time,
+        reading and decompressing release the GIL for the most part
+    - timings: if a dict is given, it is filled with
+        files, threads, wall time, summed read time and
+        slowest read time in seconds
 
     Returns:
     - result: unpickled object
     - success_files: list of successful filenames
     - errors: filenames for which exceptions happened
     """
+    t0 = perf_counter()
+    if n_threads > 1 and len(filenames) > 1:
+        loaded = _get_read_executor(n_threads).map(_read_timed, filenames)
+    else:
+        loaded = map(_read_timed, filenames)
+
+    # results are returned in the order of filenames
     result = []
     success_files = []
     errors = []
-    for f in filenames:
-        try:
-            result.append(read(f))
+    read_times = []
+    for f, (data, error, read_time) in zip(filenames, loaded):
+        read_times.append(read_time)
+        if error is None:
+            result.append(data)
             success_files.append(f)
-        except Exception as e:
+        else:
             cprint(f'Loading {f} failed!', 'red')
-            cprint(e, 'red')
+            cprint(error, 'red')
             errors.append(f)
+
+    if timings is not None:
+        timings.update({
+            'files': len(filenames),
+            'threads': n_threads,
+            'wall': perf_counter() - t0,
+            'read': sum(read_times),
+            'slowest': max(read_times, default=0)
+        })
     return result, success_files, errors
 
 
+def _read_timed(filename):
+    """
+    Returns the data of a file or None, the exception or None
+    and the time it took to read it.
+    """
+    t0 = perf_counter()
+    try:
+        return read(filename), None, perf_counter() - t0
+    except Exception as e:
+        return None, e, perf_counter() - t0
+
+
+def _get_read_executor(n_threads):
+    """
+    Returns a pool of n_threads threads, which is reused by later calls.
+    """
+    global _read_executor, _read_executor_threads
+    with _index_lock:
+        if _read_executor is None or _read_executor_threads != n_threads:
+            if _read_executor is not None:
+                _read_executor.shutdown(wait=False)
+            _read_executor = ThreadPoolExecutor(
+                max_workers=n_threads, thread_name_prefix='cache_read')
+            _read_executor_threads = n_threads
+        return _read_executor
+
+
 def read_plain(filename):
     """
     Reads a file from the cache and unpickles it.
@@ -130,14 +1028,18 @@ def delete(filename):
     """
     deleted = 0
     errors = 0
-    for f in entries():
+    removed = []
+    for f in entries(prefix=filename):
         try:
-            if f.startswith(filename):
+            if exists(join(_cache_path, f)):
                 remove(join(_cache_path, f))
                 deleted += 1
+            removed.append(f)
         except:
             cprint(f'Cannot remove from cache: {filename}', 'red')
             errors += 1
+    _remove_from_index(removed)
+    _remove_from_memory(removed)
     cprint(f'Removed from cache all files starting with {filename}', 'green')
     msg = f'Removed {deleted} files, {errors} errors'
     cprint(msg, 'yellow')
@@ -153,14 +1055,18 @@ def delete_all_clf_projs():
     """
     deleted = 0
     errors = 0
-    for f in entries():
+    removed = []
+    for f in entries(entry_type='clf_proj'):
         try:
-            if '__clf_proj_' in f:
+            if exists(join(_cache_path, f)):
                 remove(join(_cache_path, f))
                 deleted += 1
+            removed.append(f)
         except:
             cprint(f'Cannot remove from cache: {f}', 'red')
             errors += 1
+    _remove_from_index(removed)
+    _remove_from_memory(removed)
     cprint(f'Removed from cache all classifier projections', 'green')
     msg = f'Removed {deleted} files, {errors} errors'
     cprint(msg, 'yellow')
@@ -174,67 +1080,157 @@ def clear():
     """
     Deletes the cache.
     """
+    global _index
     cprint('Clearing cache', 'yellow')
-    shutil.rmtree(_cache_path, ignore_errors=True)
+    with _index_lock:
+        if _index is not None:
+            _index.close()
+            _index = None
+        shutil.rmtree(_cache_path, ignore_errors=True)
+        # long-running processes keep using the (now empty) directory
+        makedirs(_cache_path, exist_ok=True)
+    _remove_from_memory()
 
 
-def entries():
+def entries(prefix='', data_hash=None, entry_type=None):
     """
-    Lists all files in the cache.
+    Lists files in the cache using the index.
+
+    Keyword Arguments:
+    - prefix: only list files with names starting with prefix
+    - data_hash: only list files belonging to this dataset
+    - entry_type: only list files of this type, one of
+        data, proj, clf, clf_proj, preds, other
 
     Returns:
-    - list of all file names in the cache directory
+    - list of file names in the cache directory
     """
-    return [f for f in listdir(_cache_path) if isfile(join(_cache_path, f))]
+    query = 'SELECT name FROM entries WHERE name >= ?'
+    params = [prefix]
+    if prefix != '':
+        # all strings starting with prefix are smaller than this one
+        query += ' AND name < ?'
+        params.append(prefix + '\U0010ffff')
+    if data_hash is not None:
+        query += ' AND data_hash = ?'
+        params.append(data_hash)
+    if entry_type is not None:
+        query += ' AND entry_type = ?'
+        params.append(entry_type)
+    with _index_lock:
+        rows = _open_index().execute(query + ' ORDER BY name', params)
+        return [row[0] for row in rows]
 
 
-def content():
+def contains(filename):
     """
-    Returns all .json files in the cache to allow showing what
-    classifiers etc. have been trained so far.
+    Checks if a file is in the cache.
+    Files that exist but are missing in the index are added to it.
+    """
+    with _index_lock:
+        row = _open_index().execute(
+            'SELECT 1 FROM entries WHERE name = ?', (filename,)).fetchone()
+    if row is not None:
+        return True
+    if isfile(join(_cache_path, filename)):
+        add_to_index(filename)
+        return True
+    return False
+
+
+def content(data_hash=None, offset=0, limit=None, since=None):
+    """
+    Returns the arguments (and scores for classifiers) of all cache entries
+    to allow showing what classifiers etc. have been trained so far.
+    The data is read from the index, not from the .json files.
+
+    Keyword Arguments:
+    - data_hash: only return entries belonging to this dataset
+    - offset, limit: return only limit entries, starting at offset
+    - since: only return entries that changed after this token was
+        returned by an earlier call, deleted entries are listed as well
 
     Returns:
-    - a dictionary containing all files' contents
+    - a dictionary containing all entries' contents, a token for
+        later calls with since=token, whether there are more entries
+        and resync, which is True if the token is from before the index
+        was rebuilt or the cache was cleared, all entries are returned
+        then and the client has to drop the entries it knows
     """
-    cached_files = entries()
-    json_files = [f for f in cached_files if f.endswith('_args.json')]
-    datasets = []
-    classifiers = []
-    projections = []
-    classifier_projections = []
+    with _index_lock:
+        epoch = _open_index().execute(
+            'SELECT value FROM settings WHERE key = ?', ('epoch',)).fetchone()[0]
+    resync = False
+    if since is not None:
+        since_epoch, _, since_seq = str(since).partition('.')
+        if since_epoch == epoch and since_seq.isdigit():
+            since = int(since_seq)
+        else:
+            since = None
+            resync = True
 
-    for f in json_files:
-        try:
-            filepath = join(_cache_path, f)
-            contents = Path(filepath).read_text()
-            json_dict = {
-                'file': f,
-                'args': json.loads(contents)
-            }
-
-            if '__proj_' in f:
-                projections.append(json_dict)
-
-            elif '__clf_proj_' in f:
-                classifier_projections.append(json_dict)
-
-            elif '__clf_' in f:
-                # send scores for cached classifications
-                score_file = f.replace('_args.json', '_scores.json')
-                scores = Path(join(_cache_path, score_file)).read_text()
-                json_dict['scores'] = json.loads(scores)
-                classifiers.append(json_dict)
-
-            elif f.startswith('data_'):
-                datasets.append(json_dict)
-        except Exception as e:
-            cprint(
-                f'Error: Some related files may be missing for file {f}, check if you copied files correctly or run you jobs again!', 'red')
-            cprint(e, 'red')
+    query = ('SELECT file, entry_type, args, scores, seq, deleted '
+             'FROM metadata WHERE seq > ? AND seq <= ?')
+    params = []
+    if since is None:
+        query += ' AND deleted = 0'
+    if data_hash is not None:
+        query += ' AND data_hash = ?'
+        params.append(data_hash)
+    # fetch one more row to know if there are more
+    query += ' ORDER BY seq LIMIT ? OFFSET ?'
+
+    with _index_lock:
+        index = _open_index()
+        # entries written while querying are returned by the next call
+        max_seq = _next_seq(index) - 1
+        params = [since if since is not None else 0, max_seq] + params
+        params += [-1 if limit is None else limit + 1, offset]
+        rows = index.execute(query, params).fetchall()
+
+    more = limit is not None and len(rows) > limit
+    if more:
+        rows = rows[:limit]
+
+    groups = {
+        'data': [],
+        'clf': [],
+        'proj': [],
+        'clf_proj': []
+    }
+    deleted = []
+    for f, entry_type, args, scores, seq, is_deleted in rows:
+        if is_deleted:
+            deleted.append(f)
+            continue
+        if entry_type not in groups or args is None:
+            continue
+        json_dict = {
+            'file': f,
+            'args': json.loads(args)
+        }
+        if entry_type == 'clf':
+            # send scores for cached classifications
+            if scores is None:
+                cprint(
+                    f'Error: Scores are missing for file {f}, check if you copied files correctly or run you jobs again!', 'red')
+                continue
+            json_dict['scores'] = json.loads(scores)
+        groups[entry_type].append(json_dict)
+
+    # all changes up to the token have been returned
+    last_seq = max_seq
+    if more:
+        last_seq = rows[-1][4] if len(rows) > 0 else (since or 0)
+    token = f'{epoch}.{last_seq}'
 
     return {
-        'datasets': datasets,
-        'classifiers': classifiers,
-        'projections': projections,
-        'classifier_projections': classifier_projections
+        'datasets': groups['data'],
+        'classifiers': groups['clf'],
+        'projections': groups['proj'],
+        'classifier_projections': groups['clf_proj'],
+        'deleted': deleted,
+        'token': token,
+        'more': more,
+        'resync': resync
     }
@@ -1,15 +1,36 @@
-from . import tools, cache
+from . import tools, cache, data, prediction_store
 from termcolor import cprint
 from time import time
 import numpy as np
 import json
+import tempfile
 from .classifiers import get_classifier, get_classifier_info
-from .tools import get_scores, get_mean_scores
+from .tools import get_scores, get_mean_scores, get_empty_scores
+from sklearn.model_selection import train_test_split
 
 
-def classify(clf_args, clf_cache, data_bundle, write_to_cache=True):
+# arrays stored in the prediction bundle {clf_cache}_proba
+PREDICTION_KEYS = ('y_pred_test',
+                   'y_pred_train',
+                   'y_pred_proba_test',
+                   'y_pred_proba_train')
+
+
+def classify(clf_args, clf_cache, data_bundle, write_to_cache=True,
+             fold_pool=None, max_memory=None):
     """
     Classifies the data.
+
+    Keyword arguments:
+    - clf_args: classifier arguments
+    - clf_cache: hash of the classifier
+    - data_bundle: data as dict (format as output from dataset plugins)
+    - write_to_cache: if True, results are written to the cache
+    - fold_pool: pool from parallel.get_pool() with data_bundle exported,
+        which trains cross validation folds in parallel,
+        None trains them one after another
+    - max_memory: memory limit for predictions in bytes, the data is
+        predicted in batches that fit into it, None predicts it at once
     """
     cprint(f'  Title: {clf_args["title"]}', 'cyan')
     print(f'  Plugin (method): {clf_args["method"]}')
@@ -19,18 +40,37 @@ def classify(clf_args, clf_cache, data_bundle, write_to_cache=True):
 
     # check cache here again (batch.py checks too)
     # since cache might have changed
-    if clf_cache in cache.entries():
+    if cache.contains(clf_cache):
         cprint('Classifier already cached', 'green')
         return None
 
+    if not write_to_cache:
+        return _classify(clf_args, clf_cache, data_bundle, write_to_cache,
+                         fold_pool, max_memory)
+
+    # other processes (e.g. parallel workers or a second batch)
+    # skip the classifier while it is trained here
+    with cache.claim(clf_cache) as claimed:
+        if not claimed:
+            cprint('Classifier is being trained by another process', 'yellow')
+            return None
+        if cache.contains(clf_cache):
+            cprint('Classifier already cached', 'green')
+            return None
+        return _classify(clf_args, clf_cache, data_bundle, write_to_cache,
+                         fold_pool, max_memory)
+
+
+def _classify(clf_args, clf_cache, data_bundle, write_to_cache, fold_pool,
+              max_memory):
+    """
+    Classifies the data without checking the cache, see classify().
+    """
     try:
-        # cross validation can be disabled
-        cv_disabled = 'disable_cross_validation' in data_bundle[
-            'args'] and data_bundle['args']['disable_cross_validation'] == True
-
-        if not cv_disabled and 'cv_folds' in data_bundle['specs']:
+        if uses_cross_validation(data_bundle):
             # classify with cross validation
-            clf_result = classify_cv(data_bundle, clf_args, write_to_cache)
+            clf_result = classify_cv(data_bundle, clf_args, write_to_cache,
+                                     fold_pool, max_memory)
         else:
             # classify without cross validation
             X_train = data_bundle['X_train']
@@ -38,7 +78,8 @@ def classify(clf_args, clf_cache, data_bundle, write_to_cache=True):
             X_test = data_bundle['X_test']
             y_test = data_bundle['y_test']
             clf_result = classify_simple(
-                data_bundle, clf_args, X_train, y_train, X_test, y_test)
+                data_bundle, clf_args, X_train, y_train, X_test, y_test,
+                max_memory)
 
         # save data to cache
         if write_to_cache:
@@ -46,7 +87,7 @@ def classify(clf_args, clf_cache, data_bundle, write_to_cache=True):
 
         # return test scores for autotuning
         train_scores, test_scores, _, _, clf_time, \
-            pred_time, _, _, _ = clf_result
+            pred_time, _, _, _, _ = clf_result
         return train_scores, test_scores, clf_time, pred_time
 
     except Exception as e:
@@ -55,12 +96,22 @@ def classify(clf_args, clf_cache, data_bundle, write_to_cache=True):
         raise
 
 
+def uses_cross_validation(data_bundle):
+    """
+    Returns whether classifiers are trained with cross validation,
+    which the dataset must support and the batch job may disable.
+    """
+    cv_disabled = 'disable_cross_validation' in data_bundle['args'] \
+        and data_bundle['args']['disable_cross_validation'] == True
+    return not cv_disabled and 'cv_folds' in data_bundle['specs']
+
+
 def save_clf_result(clf_args, clf_cache, clf_result, data_bundle):
     """
     Writes the classification result to cache
     """
     train_scores, test_scores, y_pred_test, y_pred_train, clf_time, \
-        pred_time, history, y_prob_test, y_prob_train = clf_result
+        pred_time, history, y_prob_test, y_prob_train, proba_time = clf_result
 
     # convert history so floats so jsonpify can handle it
     hist_new = None
@@ -78,15 +129,20 @@ def save_clf_result(clf_args, clf_cache, clf_result, data_bundle):
         'data_hash': data_bundle['hash'],
         'clf_time': clf_time,
         'pred_time': pred_time,
+        'proba_time': proba_time,
+        'train_prediction': data_bundle.get('args', {}).get('train_prediction', 'full'),
         'history': hist_new
     }
 
     # store probabilities separately so frontend does not have to load them
+    # (the cache's array format decides if they are stored as lists or arrays,
+    # its precision which types are used)
+    num_classes = len(data_bundle['class_names'])
     y_pred_bundle = {
-        'y_pred_test': tools.tolist(y_pred_test),
-        'y_pred_train': tools.tolist(y_pred_train),
-        'y_pred_proba_test': tools.tolist(y_prob_test),
-        'y_pred_proba_train': tools.tolist(y_prob_train)
+        'y_pred_test': cache.compact_labels(y_pred_test, num_classes),
+        'y_pred_train': cache.compact_labels(y_pred_train, num_classes),
+        'y_pred_proba_test': cache.compact_probabilities(y_prob_test),
+        'y_pred_proba_train': cache.compact_probabilities(y_prob_train)
     }
 
     # store scores for display in menu
@@ -96,21 +152,80 @@ def save_clf_result(clf_args, clf_cache, clf_result, data_bundle):
         'hash': clf_cache,
         'data_hash': data_bundle['hash'],
         'clf_time': clf_time,
-        'pred_time': pred_time
+        'pred_time': pred_time,
+        'proba_time': proba_time
     }
 
-    # save data
+    # save data, predictions are written before the classifier bundle,
+    # since the classifier counts as cached as soon as it exists
+    stored = False
+    if cache.get_array_format() == 'columnar':
+        stored = prediction_store.append(data_bundle['hash'],
+                                         clf_cache,
+                                         y_pred_bundle)
+    if not stored:
+        cache.write_arrays(f'{clf_cache}_proba', y_pred_bundle)
     cache.write(clf_cache, clf_bundle)
-    cache.write(f'{clf_cache}_proba', y_pred_bundle)
 
     # save args and scores
     cache.write_dict_json(f'{clf_cache}_args', clf_args)
     cache.write_dict_json(f'{clf_cache}_scores', score_bundle)
 
 
-def classify_simple(data_bundle, clf_args, X_train, y_train, X_test, y_test):
+def read_predictions(clf_cache):
+    """
+    Reads the predictions and probabilities of a classifier from cache.
+    Depending on the cache's array format, they are lists or
+    memory-mapped arrays.
+    """
+    data_hash = clf_cache.split('__clf_')[0]
+    if clf_cache in prediction_store.read_index(data_hash):
+        predictions = {}
+        for key in PREDICTION_KEYS:
+            matrix, _ = prediction_store.read(data_hash, [clf_cache], key)
+            predictions[key] = matrix[0]
+    else:
+        predictions = cache.read_arrays(f'{clf_cache}_proba', PREDICTION_KEYS)
+    return {key: _expand(key, value) for key, value in predictions.items()}
+
+
+def _expand(key, array):
+    """
+    Upcasts compactly stored predictions (see cache.get_precision()).
+    """
+    if 'proba' in key:
+        return cache.expand_probabilities(array)
+    return cache.expand_labels(array)
+
+
+def read_prediction_matrix(data_hash, clf_hashes, key):
+    """
+    Reads one type of predictions (e.g. y_pred_proba_test) of multiple
+    classifiers as a matrix with one row per classifier.
+    Classifiers in the columnar prediction store are read with a single
+    sequential read, all others from their own files.
     """
-    Classification without cross validation
+    matrix, missing = prediction_store.read(data_hash, clf_hashes, key)
+    matrix = _expand(key, matrix)
+    if len(missing) == 0:
+        return matrix
+
+    # merge with classifiers that are stored separately
+    rows = {}
+    if matrix is not None:
+        missing_set = set(missing)
+        found = [h for h in clf_hashes if h not in missing_set]
+        rows = dict(zip(found, matrix))
+    for clf_hash in missing:
+        rows[clf_hash] = np.asarray(read_predictions(clf_hash)[key])
+    return np.array([rows[h] for h in clf_hashes])
+
+
+def classify_simple(data_bundle, clf_args, X_train, y_train, X_test, y_test,
+                    max_memory=None):
+    """
+    Classification without cross validation,
+    max_memory is the memory limit for predictions, see classify()
     """
     # create classifier
     clf = get_classifier(clf_args, data_bundle['specs'])
@@ -125,45 +240,47 @@ def classify_simple(data_bundle, clf_args, X_train, y_train, X_test, y_test):
     y_pred_test = y_pred_train = None
     y_prob_test = y_prob_train = None
     train_scores = test_scores = None
-    pred_time = 0
+    pred_time = proba_time = 0
 
     if len(X_test) == 0:
         cprint('No test set, skipping prediction and evaluation', 'yellow')
 
     else:
-        t1 = time()
-        print('  Predicting class labels...', end='\r')
-        y_pred_test = clf.predict(X_test, y_test)
-        y_pred_train = clf.predict(X_train, y_train)
-        pred_time = time() - t1
-
-        # also get probabilities if possible
-        print('  Predicting probabilities...', end='\r')
-        if hasattr(clf, 'predict_proba'):
-            y_prob_test = clf.predict_proba(X_test, y_test)
-            y_prob_train = clf.predict_proba(X_train, y_train)
-        elif hasattr(clf, 'decision_function'):
-            df_test = clf.decision_function(X_test, y_test)
-            df_train = clf.decision_function(X_train, y_train)
-            # normalize decision_function values to [0, 1]
-            y_prob_test = (df_test - np.min(df_test)) / np.ptp(df_test)
-            y_prob_train = (df_train - np.min(df_train)) / np.ptp(df_train)
-            # if binary classification, make format match other classifiers
-            if len(y_prob_test.shape) == 1:
-                y_prob_test = [[x, 1-x] for x in y_prob_test]
-                y_prob_train = [[x, 1-x] for x in y_prob_train]
+        print('  Predicting class labels and probabilities...', end='\r')
+        batch_size = get_prediction_batch_size(data_bundle, max_memory)
+        y_pred_test, y_prob_test, label_time_test, proba_time_test = predict(
+            clf, X_test, y_test, batch_size, max_memory)
+        pred_time = label_time_test
+        proba_time = proba_time_test
+
+        # training data is predicted completely, sampled or not at all
+        X_train_pred, y_train_pred = get_training_data_for_prediction(
+            data_bundle, X_train, y_train)
+        if X_train_pred is None:
+            y_pred_train = y_prob_train = []
+        else:
+            y_pred_train, y_prob_train, label_time_train, proba_time_train = predict(
+                clf, X_train_pred, y_train_pred, batch_size, max_memory)
+            pred_time += label_time_train
+            proba_time += proba_time_train
 
         # score
         print('  Calculating scores...', end='\r')
         classes = data_bundle['class_names']
         test_scores = get_scores(y_test, y_pred_test, classes)
-        train_scores = get_scores(y_train, y_pred_train, classes)
+        if X_train_pred is None:
+            train_scores = get_empty_scores()
+        else:
+            train_scores = get_scores(y_train_pred, y_pred_train, classes)
 
         # some stats (long enough to overwrite the lines before)
-        train_acc = train_scores['accuracy'] * 100
         test_acc = test_scores['accuracy'] * 100
         cprint(f'  Test time:  {pred_time/60:.2f} minutes    ', 'green')
-        cprint(f'  Train accuracy: {train_acc:3.2f} %        ', 'green')
+        if proba_time > 0:
+            cprint(f'  Probabilities time: {proba_time/60:.2f} minutes', 'green')
+        if train_scores['accuracy'] is not None:
+            train_acc = train_scores['accuracy'] * 100
+            cprint(f'  Train accuracy: {train_acc:3.2f} %        ', 'green')
         cprint(f'  Test accuracy:  {test_acc:3.2f} %         ', 'green')
 
     # history (Keras-like training history as dictionary with arrays)
@@ -179,73 +296,225 @@ def classify_simple(data_bundle, clf_args, X_train, y_train, X_test, y_test):
             pred_time,
             history,
             y_prob_test,
-            y_prob_train)
+            y_prob_train,
+            proba_time)
+
+
+def predict(clf, X, y, batch_size=None, max_memory=None):
+    """
+    Predicts class labels and, if supported, probabilities.
+    Classifiers that implement predict_with_proba() get both
+    with a single pass over the data.
+
+    Keyword arguments:
+    - clf: classifier
+    - X, y: data
+    - batch_size: if given, the data is passed to the classifier
+        in batches of this size, see predict_in_batches()
+    - max_memory: results larger than this (in bytes) are stored
+        in memory-mapped temporary files, only used with batch_size
+
+    Returns:
+    - class labels
+    - probabilities or None
+    - time for predicting the labels in seconds, for predict_with_proba()
+        the time of the single pass
+    - additional time for predicting the probabilities in seconds,
+        0 for predict_with_proba()
+    """
+    def call(function):
+        if batch_size is None or batch_size >= len(X):
+            return function(X, y)
+        return predict_in_batches(function, X, y, batch_size, max_memory)
+
+    t0 = time()
+    if hasattr(clf, 'predict_with_proba'):
+        y_pred, y_prob = call(clf.predict_with_proba)
+        # the single pass counts as prediction time, so it is comparable
+        # to the prediction time of classifiers without probabilities
+        return y_pred, y_prob, time() - t0, 0
 
+    y_pred = call(clf.predict)
+    label_time = time() - t0
 
-def classify_cv(data_bundle, clf_args, write_to_cache=True):
+    t0 = time()
+    y_prob = None
+    if hasattr(clf, 'predict_proba'):
+        y_prob = call(clf.predict_proba)
+    elif hasattr(clf, 'decision_function'):
+        df = call(clf.decision_function)
+        # normalize decision_function values to [0, 1]
+        y_prob = (df - np.min(df)) / np.ptp(df)
+        # if binary classification, make format match other classifiers
+        if len(y_prob.shape) == 1:
+            y_prob = [[x, 1-x] for x in y_prob]
+    return y_pred, y_prob, label_time, time() - t0
+
+
+def predict_in_batches(function, X, y, batch_size, max_memory=None):
+    """
+    Calls a prediction function for batches of samples and writes
+    the outputs into preallocated arrays, so the classifier's
+    temporary copies only have the size of one batch.
+
+    Keyword arguments:
+    - function: e.g. clf.predict, called as function(X, y)
+    - X, y: data
+    - batch_size: number of samples per batch
+    - max_memory: outputs larger than this (in bytes) are stored in
+        memory-mapped temporary files instead of memory, None for no limit
+
+    Returns:
+    - the outputs for all samples, in the same format as function
+        (an array or a tuple of arrays)
+    """
+    results = None
+    is_tuple = False
+    for start in range(0, len(X), batch_size):
+        end = min(start + batch_size, len(X))
+        output = function(X[start:end], y[start:end])
+        is_tuple = isinstance(output, tuple)
+        parts = output if is_tuple else (output,)
+        parts = [np.asarray(part) for part in parts]
+        # allocate outputs for all samples after the first batch
+        if results is None:
+            results = [_allocate_output(len(X), part, max_memory)
+                       for part in parts]
+        for result, part in zip(results, parts):
+            result[start:end] = part
+    if is_tuple:
+        return tuple(results)
+    return results[0]
+
+
+def _allocate_output(n, first_batch, max_memory):
+    shape = (n,) + first_batch.shape[1:]
+    dtype = first_batch.dtype
+    size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+    if max_memory is not None and size > max_memory and dtype != object:
+        # the temporary file is deleted once the array is not used anymore
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype,
+                         mode='w+', shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+
+def get_training_data_for_prediction(data_bundle, X_train, y_train):
+    """
+    Returns the training data that is predicted to get training scores
+    and probabilities, depending on the batch job's data config:
+    - train_prediction 'full' (default): all training data
+    - train_prediction 'sample': a fixed, stratified sample with
+        train_prediction_samples (default 1000) samples
+    - train_prediction 'none': None, None (nothing is predicted)
+
+    Returns:
+    - X, y
+    """
+    args = data_bundle.get('args', {})
+    mode = tools.check_arg('train_prediction',
+                           args.get('train_prediction', 'full'),
+                           str,
+                           ('full', 'sample', 'none'))
+    if mode == 'none':
+        return None, None
+    if mode == 'full':
+        return X_train, y_train
+
+    n_samples = tools.check_arg('train_prediction_samples',
+                                args.get('train_prediction_samples', 1000),
+                                int,
+                                (1, 1e12))
+    if n_samples >= len(X_train):
+        return X_train, y_train
+    indices = np.arange(len(X_train))
+    random_state = args.get('random_state', 0)
+    try:
+        sample, _ = train_test_split(indices,
+                                     train_size=n_samples,
+                                     stratify=y_train,
+                                     random_state=random_state)
+    except ValueError:
+        # stratification fails for multi-label data and very small classes
+        sample, _ = train_test_split(indices,
+                                     train_size=n_samples,
+                                     random_state=random_state)
+    # keep the original order of samples
+    sample = np.sort(sample)
+    return X_train[sample], y_train[sample]
+
+
+def get_prediction_batch_size(data_bundle, max_memory):
+    """
+    Returns the number of samples that can be predicted at once
+    without exceeding max_memory (in bytes),
+    None if there is no limit.
+    """
+    if max_memory is None:
+        return None
+    X = data_bundle['X_train']
+    values_per_sample = int(np.prod(X.shape[1:], dtype=np.int64))
+    num_classes = data_bundle['specs']['num_classes']
+    # plugins may convert each batch (e.g. to float32 and then float64),
+    # outputs are probabilities and labels
+    bytes_per_sample = values_per_sample * (X.itemsize + 4 + 8) \
+        + num_classes * 8 + 8
+    return max(1, max_memory // bytes_per_sample)
+
+
+def classify_cv(data_bundle, clf_args, write_to_cache=True, fold_pool=None,
+                max_memory=None):
     """
     Classification with cross validation
 
     - Scores are averaged
     - Predictions for each fold's test set are merged
     - History is not saved
+    - With a fold_pool (see classify()), folds are trained in parallel
+    - max_memory: memory limit for predictions, see classify()
     """
     print('Using cross validation')
     specs = data_bundle['specs']
     cv_folds = specs['cv_folds']
-    cv_on_test_set = 'cv_folds_for_test_only' in specs and specs['cv_folds_for_test_only']
 
     # folds may be numbered starting with 0 or 1
     start = np.min(cv_folds)
     end = np.max(cv_folds)
     num_folds = end - start + 1
+    folds = list(range(start, end + 1))
+
+    # run all folds
+    if fold_pool is not None and num_folds > 1:
+        # imported here, since parallel imports this module
+        from . import parallel
+        tasks = [(clf_args, current_fold, write_to_cache, max_memory)
+                 for current_fold in folds]
+        fold_results = parallel.run_folds(tasks, fold_pool)
+    else:
+        fold_results = (classify_fold(data_bundle,
+                                      clf_args,
+                                      current_fold,
+                                      write_to_cache,
+                                      max_memory)
+                        for current_fold in folds)
 
     # initialize mean scores
     train_scores_list = []
     test_scores_list = []
-    clf_time_sum = pred_time_sum = 0
+    clf_time_sum = pred_time_sum = proba_time_sum = 0
     merged_pred_test = merged_prob_test = None
     first_fold = True
 
-    # run all folds
-    for current_fold in range(start, end+1):
-        # get data from data_bundle depending on fold specs
-        X_train, y_train, X_test, y_test = get_data_for_fold(data_bundle,
-                                                             cv_folds,
-                                                             current_fold,
-                                                             cv_on_test_set)
-        cprint(f'\nFold {current_fold} / {num_folds}', 'cyan')
-        print(f'Training samples: {len(y_train)} test samples: {len(y_test)}')
-
-        # change title to contain fold number
-        clf_args2 = clf_args.copy()
-        clf_args2['title'] += f' fold{current_fold}'
-
-        # run simple classification
-        clf_result = classify_simple(data_bundle,
-                                     clf_args2,
-                                     X_train,
-                                     y_train,
-                                     X_test,
-                                     y_test)
+    # results are in fold order, also when running in parallel
+    for clf_result in fold_results:
         train_scores, test_scores, y_pred_test, y_pred_train, clf_time, \
-            pred_time, history, y_prob_test, y_prob_train = clf_result
-
-        # store single results for each fold?
-        if write_to_cache:
-            if 'save_clfs_for_folds' in data_bundle['args']:
-                if data_bundle['args']['save_clfs_for_folds'] == True:
-                    clf_cache = f'{data_bundle["hash"]}__clf_{tools.hash(clf_args2)}'
-                    save_clf_result(clf_args2,
-                                    clf_cache,
-                                    clf_result,
-                                    data_bundle)
+            pred_time, history, y_prob_test, y_prob_train, proba_time = clf_result
 
         # store mean of results
         train_scores_list.append(train_scores)
         test_scores_list.append(test_scores)
         clf_time_sum += clf_time
         pred_time_sum += pred_time
+        proba_time_sum += proba_time
 
         # concat predictions (needed for clf projections)
         if first_fold:
@@ -261,11 +530,16 @@ def classify_cv(data_bundle, clf_args, write_to_cache=True):
     test_scores = get_mean_scores(test_scores_list)
     clf_time = clf_time_sum / num_folds
     pred_time = pred_time_sum / num_folds
+    proba_time = proba_time_sum / num_folds
 
     # print summary
     print('\nAll folds finished!')
-    cprint('  Mean train accuracy: {:.2f} %\n  Mean test accuracy: {:.2f} %'.format(
-        train_scores['accuracy'] * 100, test_scores['accuracy'] * 100), 'green')
+    # train accuracy is missing when training data is not predicted
+    train_acc = 'n/a'
+    if train_scores['accuracy'] is not None:
+        train_acc = '{:.2f} %'.format(train_scores['accuracy'] * 100)
+    cprint('  Mean train accuracy: {}\n  Mean test accuracy: {:.2f} %'.format(
+        train_acc, test_scores['accuracy'] * 100), 'green')
     cprint('  Mean training time: {:.2f} minutes'.format(clf_time/60), 'green')
     cprint('  Total training time: {:.2f} minutes'.format(
         clf_time_sum/60), 'green')
@@ -279,30 +553,97 @@ def classify_cv(data_bundle, clf_args, write_to_cache=True):
             pred_time,
             history,
             merged_prob_test,
-            [])  # no train probabilities
+            [],  # no train probabilities
+            proba_time)
+
+
+def classify_fold(data_bundle, clf_args, current_fold, write_to_cache=True,
+                  max_memory=None):
+    """
+    Trains and evaluates a classifier on a single cross validation fold.
+    Stores the result if data_bundle['args']['save_clfs_for_folds'] is True.
+    max_memory is the memory limit for predictions, see classify().
+
+    Returns:
+    - result in the same format as classify_simple()
+    """
+    specs = data_bundle['specs']
+    cv_folds = specs['cv_folds']
+    cv_on_test_set = 'cv_folds_for_test_only' in specs and specs['cv_folds_for_test_only']
+    num_folds = np.max(cv_folds) - np.min(cv_folds) + 1
+
+    # get data from data_bundle depending on fold specs
+    X_train, y_train, X_test, y_test = get_data_for_fold(data_bundle,
+                                                         current_fold,
+                                                         cv_on_test_set)
+    cprint(f'\nFold {current_fold} / {num_folds}', 'cyan')
+    print(f'Training samples: {len(y_train)} test samples: {len(y_test)}')
+
+    # change title to contain fold number
+    clf_args2 = clf_args.copy()
+    clf_args2['title'] += f' fold{current_fold}'
+
+    # run simple classification
+    clf_result = classify_simple(data_bundle,
+                                 clf_args2,
+                                 X_train,
+                                 y_train,
+                                 X_test,
+                                 y_test,
+                                 max_memory)
+
+    # store single results for each fold?
+    if write_to_cache:
+        if 'save_clfs_for_folds' in data_bundle['args']:
+            if data_bundle['args']['save_clfs_for_folds'] == True:
+                clf_cache = f'{data_bundle["hash"]}__clf_{tools.hash(clf_args2)}'
+                save_clf_result(clf_args2,
+                                clf_cache,
+                                clf_result,
+                                data_bundle)
+
+    return clf_result
+
+
+def get_fold_indices(data_bundle):
+    """
+    Returns the indices of the test samples for each fold as
+    a dict {fold: indices}. They are views on data_bundle['fold_order'],
+    which is computed when the data is prepared (see data.sort_folds()).
+    """
+    if 'fold_order' not in data_bundle:
+        # data that has been cached without the splits
+        data_bundle['fold_order'], data_bundle['fold_bounds'] = \
+            data.sort_folds(data_bundle['specs']['cv_folds'])
+    order = data_bundle['fold_order']
+    return {fold: order[start:end]
+            for fold, start, end in data_bundle['fold_bounds'].tolist()}
+
+
+def _take(array, indices):
+    """
+    Returns array[indices], as a view if the indices are a contiguous range.
+    """
+    if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1:
+        return array[indices[0]:indices[-1] + 1]
+    return array[indices]
 
 
-def get_data_for_fold(data_bundle, cv_folds, current_fold, cv_on_test_set):
+def get_data_for_fold(data_bundle, current_fold, cv_on_test_set):
     """
     Splits data into train and test set depending
     on the current fold and cross validation mode
     """
-    X_train = []
-    y_train = []
-    X_test = []
-    y_test = []
+    fold_indices = get_fold_indices(data_bundle)
+    test_indices = fold_indices.get(current_fold, np.array([], dtype=int))
 
     if cv_on_test_set:
         # training data is in X_train
         X_train = data_bundle['X_train']
         y_train = data_bundle['y_train']
         # test data has to be splitted
-        X_set = data_bundle['X_test']
-        y_set = data_bundle['y_test']
-        for i in range(len(X_set)):
-            if cv_folds[i] == current_fold:
-                X_test.append(X_set[i])
-                y_test.append(y_set[i])
+        X_test = _take(data_bundle['X_test'], test_indices)
+        y_test = _take(data_bundle['y_test'], test_indices)
 
     else:
         # all data is in the train set,
@@ -311,15 +652,11 @@ def get_data_for_fold(data_bundle, cv_folds, current_fold, cv_on_test_set):
         y_set = data_bundle['y_train']
         # put data labelled with the current fold number
         # into test set and the rest into train set
-        for i in range(len(X_set)):
-            if cv_folds[i] == current_fold:
-                X_test.append(X_set[i])
-                y_test.append(y_set[i])
-            else:
-                X_train.append(X_set[i])
-                y_train.append(y_set[i])
-
-    return (np.array(X_train),
-            np.array(y_train),
-            np.array(X_test),
-            np.array(y_test))
+        train_mask = np.ones(len(X_set), dtype=bool)
+        train_mask[test_indices] = False
+        X_train = X_set[train_mask]
+        y_train = y_set[train_mask]
+        X_test = _take(X_set, test_indices)
+        y_test = _take(y_set, test_indices)
+
+    return X_train, y_train, X_test, y_test
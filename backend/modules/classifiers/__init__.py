@@ -45,6 +45,16 @@ def get_classifier_info():
     }
 
 
+def get_classifier_resources(method):
+    """
+    Returns the resource hints of a classifier (see README.md),
+    an empty dict if it does not specify any.
+    """
+    if method in plugins:
+        return plugins[method].get_info().get('resources') or {}
+    return {}
+
+
 def get_classifier(args, data_specs):
     method = args['method']
     if method in plugins:
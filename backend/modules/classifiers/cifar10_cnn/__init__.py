@@ -7,6 +7,7 @@ from keras.layers import Conv2D, MaxPooling2D
 from keras.callbacks import EarlyStopping
 import os
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 from termcolor import cprint
 
 """
@@ -17,6 +18,11 @@ CLF_INFO = {
     'name': 'cifar10_cnn',
     'short': 'C10 CNN',
     'description': 'Cifar10 Convolutional Neural Network',
+    'resources': {
+        'threads': 4,
+        'memory': 2048,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'save_model',
@@ -262,3 +268,8 @@ class Classifier():
         X_test = X_test.reshape(new_shape)
 
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        y_prob = self.predict_proba(X_test, y_test)
+        return classes_from_proba(y_prob), y_prob
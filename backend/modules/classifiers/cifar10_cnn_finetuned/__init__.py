@@ -4,12 +4,18 @@ from keras.models import load_model
 import os
 from termcolor import cprint
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 
 
 CLF_INFO = {
     'name': 'cifar10_cnn_finetuned',
     'short': 'C10 CNN (fine-t)',
     'description': 'Cifar10 Convolutional Neural Network (fine-tuned)',
+    'resources': {
+        'threads': 4,
+        'memory': 2048,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'model_file',
@@ -239,3 +245,8 @@ class Classifier():
         X_test = X_test.reshape(new_shape)
 
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        y_prob = self.predict_proba(X_test, y_test)
+        return classes_from_proba(y_prob), y_prob
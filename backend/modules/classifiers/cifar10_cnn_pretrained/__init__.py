@@ -1,12 +1,18 @@
 from keras.models import load_model
 from termcolor import cprint
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 
 
 CLF_INFO = {
     'name': 'cifar10_cnn_pretrained',
     'short': 'C10 CNN (pre-tr)',
     'description': 'Cifar10 Convolutional Neural Network (pretrained)',
+    'resources': {
+        'threads': 4,
+        'memory': 2048,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'model_file',
@@ -72,3 +78,8 @@ class Classifier():
         X_test = X_test.reshape(new_shape)
 
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        y_prob = self.predict_proba(X_test, y_test)
+        return classes_from_proba(y_prob), y_prob
@@ -1,3 +1,4 @@
+import numpy as np
 from sklearn.neighbors import KNeighborsClassifier
 from ...tools import check_argument as check
 
@@ -6,6 +7,10 @@ CLF_INFO = {
     'name': 'kneighbors',
     'short': 'KNN',
     'description': 'k Nearest Neighbors Classifier',
+    'resources': {
+        'threads': 2,
+        'memory': 256
+    },
     'parameters': [
         {
             'name': 'n_neighbors',
@@ -43,3 +48,9 @@ class Classifier():
 
     def predict_proba(self, X_test, y_test):
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # labels are the classes with the highest probability,
+        # same as predict() but with a single pass
+        y_prob = self.clf.predict_proba(X_test)
+        return self.clf.classes_[np.argmax(y_prob, axis=1)], y_prob
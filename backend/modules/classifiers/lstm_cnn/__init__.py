@@ -6,12 +6,18 @@ from keras.layers.embeddings import Embedding
 from keras.callbacks import EarlyStopping
 from termcolor import cprint
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 
 
 CLF_INFO = {
     'name': 'lstm_cnn',
     'short': 'LSTM CNN',
     'description': 'Long Short-term Memory Convolutional Neural Network',
+    'resources': {
+        'threads': 4,
+        'memory': 2048,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'save_model',
@@ -220,3 +226,13 @@ class Classifier():
                 pred_fixed.append([p, 1 - p])
             pred = pred_fixed
         return pred
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        pred = self.clf.predict_proba(X_test)
+        labels = classes_from_proba(pred)
+        # same fixes as in predict() and predict_proba()
+        if self.num_classes == 2:
+            labels = [int(p[0]) for p in labels]
+            pred = [[p[0], 1 - p[0]] for p in pred]
+        return labels, pred
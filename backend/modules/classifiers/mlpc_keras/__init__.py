@@ -6,12 +6,18 @@ from keras import optimizers
 from keras.callbacks import EarlyStopping
 from termcolor import cprint
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 
 
 CLF_INFO = {
     'name': 'mlpc_keras',
     'short': 'MLPC (k)',
     'description': 'Multi-layer Perceptron (Keras)',
+    'resources': {
+        'threads': 2,
+        'memory': 1024,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'save_model',
@@ -237,3 +243,8 @@ class Classifier():
 
     def predict_proba(self, X_test, y_test):
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        y_prob = self.predict_proba(X_test, y_test)
+        return classes_from_proba(y_prob), y_prob
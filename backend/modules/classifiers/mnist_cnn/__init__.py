@@ -8,6 +8,7 @@ from keras.callbacks import EarlyStopping
 import os
 from termcolor import cprint
 from ...tools import check_argument as check
+from ...tools import classes_from_proba
 
 '''
 From https://github.com/keras-team/keras/blob/master/examples/mnist_cnn.py
@@ -23,6 +24,11 @@ CLF_INFO = {
     'name': 'mnist_cnn',
     'short': 'MNIST CNN',
     'description': 'MNIST Convolutional Neural Network',
+    'resources': {
+        'threads': 4,
+        'memory': 2048,
+        'accelerator': 'gpu'
+    },
     'parameters': [
         {
             'name': 'save_model',
@@ -200,3 +206,8 @@ class Classifier():
         X_test = X_test.reshape(new_shape)
 
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # a single forward pass for labels and probabilities
+        y_prob = self.predict_proba(X_test, y_test)
+        return classes_from_proba(y_prob), y_prob
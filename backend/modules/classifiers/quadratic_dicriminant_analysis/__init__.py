@@ -1,3 +1,4 @@
+import numpy as np
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
 from ...tools import check_argument as check
 
@@ -33,3 +34,9 @@ class Classifier():
 
     def predict_proba(self, X_test, y_test):
         return self.clf.predict_proba(X_test)
+
+    def predict_with_proba(self, X_test, y_test):
+        # labels are the classes with the highest probability,
+        # same as predict() but with a single pass
+        y_prob = self.clf.predict_proba(X_test)
+        return self.clf.classes_[np.argmax(y_prob, axis=1)], y_prob
@@ -7,6 +7,10 @@ CLF_INFO = {
     'name': 'random_forest_multi_label',
     'short': 'RF',
     'description': 'Multi-label Random Forest',
+    'resources': {
+        'threads': 4,
+        'memory': 512
+    },
     'parameters': [
         {
             'name': 'n_estimators',
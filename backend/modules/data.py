@@ -19,7 +19,7 @@ def get_data(data_args,
 
     print(f'\n  Dataset: {data_args["dataset"]}\n  Hash: {data_cache}')
 
-    if read_from_cache and data_cache in cache.entries():
+    if read_from_cache and cache.contains(data_cache):
         data_bundle = cache.read(data_cache)
         print_data_stats(data_bundle)
     else:
@@ -128,6 +128,10 @@ def get_data(data_args,
                 # show info on cv folds (folds may be numbered starting with 0 or 1)
                 show_fold_sizes(cv_folds, cv_on_test_set)
 
+                # the splits are cached with the data
+                data_bundle['fold_order'], data_bundle['fold_bounds'] = \
+                    sort_folds(cv_folds)
+
         if write_to_cache:
             cache.write(data_cache, data_bundle)
         if write_args_to_cache:
@@ -206,23 +210,35 @@ def show_fold_sizes(cv_folds, cv_on_test_set):
     cprint(
         f'\nUsing cross validation with {num_folds} folds from {start} to {end}')
 
+    folds, sizes = np.unique(cv_folds, return_counts=True)
+    sizes = dict(zip(folds.tolist(), sizes.tolist()))
+
     if cv_on_test_set:
         print(f'  Fold sizes (splits of original test set):')
         for current_fold in range(start, end + 1):
-            size = 0
-            for i in range(len(cv_folds)):
-                if cv_folds[i] == current_fold:
-                    size += 1
+            size = sizes.get(current_fold, 0)
             print(f'    {current_fold:2} {size:7}')
 
     else:
         print(f'  Fold sizes (train and test):')
         for current_fold in range(start, end + 1):
-            train_size = 0
-            test_size = 0
-            for i in range(len(cv_folds)):
-                if cv_folds[i] == current_fold:
-                    test_size += 1
-                else:
-                    train_size += 1
+            test_size = sizes.get(current_fold, 0)
+            train_size = len(cv_folds) - test_size
             print(f'    {current_fold:2} {train_size:7} {test_size:7}')
+
+
+def sort_folds(cv_folds):
+    """
+    Sorts the samples by cross validation fold, so the test samples
+    of each fold are a slice of the order.
+
+    Returns:
+    - order: sample indices sorted by fold, the samples of each fold
+        keep their order
+    - fold_bounds: array with a row (fold, start, end) for each fold
+    """
+    cv_folds = np.asarray(cv_folds)
+    order = np.argsort(cv_folds, kind='stable')
+    folds, starts = np.unique(cv_folds[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return order, np.stack((folds, starts, ends), axis=1).astype(np.int64)
@@ -0,0 +1,208 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# number of set bits for every possible byte value,
+# used to count differing bits of bit-packed vectors
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                           dtype=np.uint8)
+
+# upper bound for the temporary memory used per row block
+DEFAULT_MAX_BLOCK_BYTES = 64 * 1024 * 1024
+
+METRICS = ('euclidean', 'cosine', 'correlation', 'hamming')
+
+
+def condensed_size(n):
+    """
+    Returns the length of a condensed distance matrix for n items.
+    """
+    return n * (n - 1) // 2
+
+
+def condensed_index(n, i, j):
+    """
+    Returns the index of the distance between items i and j (i < j)
+    in a condensed distance matrix for n items.
+    Works with scalars and NumPy arrays.
+    """
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def num_items(condensed):
+    """
+    Returns the number of items n for a condensed distance matrix.
+    """
+    n = int(round((1 + np.sqrt(1 + 8 * len(condensed))) / 2))
+    if condensed_size(n) != len(condensed):
+        raise Exception(
+            f'Invalid condensed distance matrix of length {len(condensed)}')
+    return n
+
+
+def pairwise_distances(data, metric='euclidean', n_jobs=1,
+                       max_block_bytes=DEFAULT_MAX_BLOCK_BYTES):
+    """
+    Computes all pairwise distances between the rows of data.
+
+    The matrix is computed in row blocks, so the temporary memory
+    stays below max_block_bytes. Euclidean, cosine and correlation
+    distances use matrix products (BLAS), hamming distances of binary
+    data are computed on bit-packed rows.
+
+    Keyword arguments:
+    - data: 2D array with shape (n_items, n_values_per_item)
+    - metric: one of euclidean, cosine, correlation, hamming
+    - n_jobs: number of threads that compute blocks in parallel
+    - max_block_bytes: memory limit for temporary block results
+
+    Returns:
+    - condensed float32 distance matrix with the same layout as
+        scipy.spatial.distance.pdist, i.e. entries (i, j) with i < j
+        in row-major order
+    """
+    if metric not in METRICS:
+        raise Exception(
+            f'Invalid distance metric "{metric}", must be in {METRICS}')
+    data = np.asarray(data)
+    if data.ndim != 2:
+        data = data.reshape(len(data), -1)
+    n = len(data)
+    condensed = np.zeros(condensed_size(n), dtype=np.float32)
+    if n < 2:
+        return condensed
+
+    if metric == 'hamming':
+        prepared, block_distances, row_bytes = _prepare_hamming(data)
+    else:
+        prepared, block_distances, row_bytes = _prepare_gram(data, metric)
+
+    # each block holds rows [start, end) compared to all rows >= start
+    block_rows = max(1, int(max_block_bytes // max(1, row_bytes)))
+    blocks = [(start, min(n, start + block_rows))
+              for start in range(0, n - 1, block_rows)]
+
+    def fill_block(block):
+        start, end = block
+        dist = block_distances(prepared, start, end)
+        # copy the part right of the diagonal into the condensed matrix
+        for i in range(start, end):
+            offset = condensed_index(n, i, i + 1)
+            condensed[offset:offset + n - i - 1] = dist[i - start, i - start + 1:]
+
+    if n_jobs is not None and n_jobs != 1 and len(blocks) > 1:
+        max_workers = None if n_jobs < 0 else n_jobs
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fill_block, blocks))
+    else:
+        for block in blocks:
+            fill_block(block)
+
+    return condensed
+
+
+def _prepare_gram(data, metric):
+    """
+    Prepares data for distances that can be computed from the
+    Gram matrix X * X^T.
+    """
+    # the Gram matrix trick cancels badly in low precision,
+    # e.g. for probabilities stored as float32 or float16
+    X = data.astype(np.float64, copy=False)
+
+    if metric == 'euclidean':
+        # centering does not change distances, but reduces cancellation
+        X = X - X.mean(axis=0)
+    elif metric == 'correlation':
+        X = X - X.mean(axis=1, keepdims=True)
+
+    sq_norms = np.einsum('ij,ij->i', X, X)
+
+    if metric in ('cosine', 'correlation'):
+        # rows with zero norm are kept as they are
+        norms = np.sqrt(sq_norms)
+        norms[norms == 0] = 1
+        X = X / norms[:, None]
+
+    def block_distances(X, start, end):
+        gram = X[start:end] @ X[start:].T
+        if metric == 'euclidean':
+            sq = sq_norms[start:end, None] + sq_norms[None, start:] - 2 * gram
+            np.maximum(sq, 0, out=sq)
+            return np.sqrt(sq)
+        dist = 1 - gram
+        np.clip(dist, 0, 2, out=dist)
+        return dist
+
+    row_bytes = len(X) * np.dtype(np.float64).itemsize * 2
+    return X, block_distances, row_bytes
+
+
+def _prepare_hamming(data):
+    """
+    Prepares data for hamming distances (fraction of differing values).
+    Binary data is bit-packed and compared via XOR and popcount,
+    other data is compared value by value.
+    """
+    n_values = data.shape[1]
+    is_binary = n_values > 0 and np.all((data == 0) | (data == 1))
+
+    if is_binary:
+        packed = np.packbits(data.astype(bool), axis=1)
+
+        def block_distances(packed, start, end):
+            differing = np.zeros((end - start, len(packed) - start))
+            for i in range(start, end):
+                xor = np.bitwise_xor(packed[start:], packed[i])
+                differing[i - start] = _POPCOUNT_TABLE[xor].sum(axis=1)
+            return differing / n_values
+
+        row_bytes = len(data) * 8
+        return packed, block_distances, row_bytes
+
+    def block_distances(data, start, end):
+        differing = np.zeros((end - start, len(data) - start))
+        for i in range(start, end):
+            differing[i - start] = np.count_nonzero(
+                data[start:] != data[i], axis=1)
+        return differing / max(1, n_values)
+
+    row_bytes = len(data) * 8
+    return data, block_distances, row_bytes
+
+
+def normalize(condensed):
+    """
+    Normalizes a condensed distance matrix to [0, 1] in place.
+    """
+    if len(condensed) > 0:
+        max_dist = condensed.max()
+        if max_dist > 0:
+            condensed /= max_dist
+    return condensed
+
+
+def to_lower_triangular(condensed):
+    """
+    Returns the lower-triangular list representation of a condensed
+    distance matrix, i.e. row i contains the distances to all j < i.
+    """
+    n = num_items(condensed)
+    rows = []
+    for i in range(n):
+        j = np.arange(i)
+        rows.append(condensed[condensed_index(n, j, i)].tolist())
+    return rows
+
+
+def to_square(condensed):
+    """
+    Returns the full symmetric distance matrix for a condensed
+    distance matrix.
+    """
+    n = num_items(condensed)
+    square = np.zeros((n, n), dtype=condensed.dtype)
+    i, j = np.triu_indices(n, k=1)
+    square[i, j] = condensed
+    square[j, i] = condensed
+    return square
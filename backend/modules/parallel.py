@@ -0,0 +1,305 @@
+"""
+Helpers for running classifiers and projections in a pool of
+worker processes.
+
+The data bundle is written to memory-mapped .npy files once and
+loaded by each worker when it starts, so the (possibly large) arrays
+are neither pickled for every task nor copied into each process.
+"""
+
+import multiprocessing
+import shutil
+import tempfile
+import traceback
+from contextlib import contextmanager, nullcontext
+from time import process_time
+from os import environ
+from os.path import join
+import numpy as np
+from termcolor import cprint
+from . import cache, classification, projection
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    # only libraries that are imported after setting the environment
+    # variables are limited
+    threadpool_limits = None
+
+# data bundle of the current worker process
+_data_bundle = None
+
+
+# environment variables that limit the threads of numerical libraries,
+# joblib (n_jobs=-1 in scikit-learn) and TensorFlow (intra-op threads)
+THREAD_ENV_VARS = ('OMP_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS',
+                   'NUMBA_NUM_THREADS',
+                   'LOKY_MAX_CPU_COUNT',
+                   'TF_NUM_INTRAOP_THREADS')
+
+
+def export_bundle(data_bundle):
+    """
+    Writes all arrays of a data bundle (and its specs) to a temporary
+    directory, so they can be shared with worker processes.
+    Add further arrays (e.g. the combined data for projections) to
+    the bundle before exporting it, to share them as well.
+
+    Returns:
+    - shared: a small, picklable description of the bundle,
+        pass it to import_bundle() and remove_bundle()
+    """
+    directory = tempfile.mkdtemp(prefix='clavis_bundle_')
+    arrays = {}
+    bundle = {}
+    for key, value in data_bundle.items():
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            path = join(directory, f'{key}.npy')
+            np.save(path, value)
+            arrays[key] = path
+        elif key == 'specs':
+            specs = {}
+            for k, v in value.items():
+                if isinstance(v, np.ndarray) and v.dtype != object:
+                    path = join(directory, f'specs_{k}.npy')
+                    np.save(path, v)
+                    arrays[f'specs.{k}'] = path
+                else:
+                    specs[k] = v
+            bundle['specs'] = specs
+        else:
+            bundle[key] = value
+    return {
+        'directory': directory,
+        'arrays': arrays,
+        'bundle': bundle
+    }
+
+
+def import_bundle(shared):
+    """
+    Returns the data bundle described by shared with memory-mapped arrays.
+    The arrays are copy-on-write, so plugins may modify them in-place
+    without affecting other processes.
+    """
+    bundle = dict(shared['bundle'])
+    bundle['specs'] = dict(bundle.get('specs', {}))
+    for key, path in shared['arrays'].items():
+        array = np.load(path, mmap_mode='c')
+        if key.startswith('specs.'):
+            bundle['specs'][key[len('specs.'):]] = array
+        else:
+            bundle[key] = array
+    return bundle
+
+
+def remove_bundle(shared):
+    """
+    Removes the temporary files of an exported bundle.
+    """
+    shutil.rmtree(shared['directory'], ignore_errors=True)
+
+
+@contextmanager
+def _thread_env(n_threads):
+    """
+    Sets THREAD_ENV_VARS to n_threads while the block runs.
+    """
+    old_env = {k: environ.get(k) for k in THREAD_ENV_VARS}
+    for k in THREAD_ENV_VARS:
+        environ[k] = str(n_threads)
+    try:
+        yield
+    finally:
+        for k, v in old_env.items():
+            if v is None:
+                environ.pop(k, None)
+            else:
+                environ[k] = v
+
+
+@contextmanager
+def limit_threads(n_threads):
+    """
+    Limits the threads of numerical libraries in the current process
+    while the block runs, so one worker process can run tasks with
+    different numbers of threads.
+    TensorFlow reads its limit only once, when it is first used
+    in a process.
+    """
+    with _thread_env(n_threads):
+        if threadpool_limits is None:
+            yield
+        else:
+            with threadpool_limits(limits=n_threads):
+                yield
+
+
+def _init_worker(shared, cache_args):
+    global _data_bundle
+    cache.init(**cache_args)
+    _data_bundle = import_bundle(shared)
+
+
+def _classify(task):
+    """
+    Trains a single classifier in a worker process.
+
+    Returns:
+    - the task's title and an error message or None
+    """
+    clf_args, clf_cache, max_memory = task
+    try:
+        classification.classify(clf_args, clf_cache, _data_bundle,
+                                max_memory=max_memory)
+        return clf_args['title'], None
+    except Exception as e:
+        cprint(f'Error in worker for classifier {clf_args["title"]}', 'red')
+        traceback.print_exc()
+        return clf_args['title'], str(e)
+
+
+def classify_measured(task):
+    """
+    Trains a single classifier in a worker process and measures
+    the processor time it used.
+
+    Keyword arguments:
+    - task: (index, clf_args, clf_cache, n_threads, max_memory),
+        numerical libraries are limited to n_threads while training,
+        max_memory is the memory limit for predictions
+
+    Returns:
+    - index, title, error message or None, processor time in seconds
+    """
+    index, clf_args, clf_cache, n_threads, max_memory = task
+    t0 = process_time()
+    with limit_threads(n_threads):
+        title, error = _classify((clf_args, clf_cache, max_memory))
+    return index, title, error, process_time() - t0
+
+
+def _classify_fold(task):
+    """
+    Trains a classifier on a single cross validation fold
+    in a worker process.
+
+    Returns:
+    - result of classification.classify_fold()
+    """
+    clf_args, current_fold, write_to_cache, max_memory = task
+    return classification.classify_fold(_data_bundle,
+                                        clf_args,
+                                        current_fold,
+                                        write_to_cache,
+                                        max_memory)
+
+
+def _project(task):
+    """
+    Projects the shared data in a worker process.
+
+    Returns:
+    - the task's title and an error message or None
+    """
+    proj_args, proj_cache, n_jobs = task
+    X_combined = _data_bundle['X_combined']
+    # training and test data are views on the combined data
+    n_train = len(_data_bundle['y_train'])
+    bundle = dict(_data_bundle,
+                  X_train=X_combined[:n_train],
+                  X_test=X_combined[n_train:])
+    try:
+        projection.project(proj_args,
+                           proj_cache,
+                           bundle,
+                           X_combined=X_combined,
+                           n_jobs=n_jobs)
+        return proj_args['title'], None
+    except Exception as e:
+        cprint(f'Error in worker for projection {proj_args["title"]}', 'red')
+        traceback.print_exc()
+        return proj_args['title'], str(e)
+
+
+def get_pool(n_workers, shared, n_threads=None):
+    """
+    Creates a pool of worker processes that have the shared bundle loaded
+    and the cache initialized like in the current process.
+
+    Keyword arguments:
+    - n_workers: number of processes
+    - shared: output of export_bundle()
+    - n_threads: if given, numerical libraries in each process are
+        limited to this number of threads
+    """
+    # spawn new processes instead of forking, since TensorFlow
+    # does not support being used in forked processes
+    context = multiprocessing.get_context('spawn')
+    # the environment is inherited by the new processes,
+    # libraries read it when they are imported
+    with _thread_env(n_threads) if n_threads is not None else nullcontext():
+        return context.Pool(n_workers,
+                            initializer=_init_worker,
+                            initargs=(shared, cache.get_init_args()))
+
+
+def _run_tasks(function, tasks, pool, callback):
+    errors = []
+    for title, error in pool.imap_unordered(function, tasks):
+        if error is not None:
+            errors.append((title, error))
+        if callback is not None:
+            callback(title, error)
+    return errors
+
+
+def run_classifiers(tasks, pool, callback=None):
+    """
+    Trains classifiers in a pool of worker processes.
+
+    Keyword arguments:
+    - tasks: list of (clf_args, clf_cache, max_memory), max_memory is
+        the memory limit for predictions (see classification.classify())
+    - pool: pool from get_pool()
+    - callback: called with (title, error) for each finished task,
+        may raise an exception to stop all remaining tasks
+
+    Returns:
+    - list of (title, error message) for failed classifiers
+    """
+    return _run_tasks(_classify, tasks, pool, callback)
+
+
+def run_projections(tasks, pool, callback=None):
+    """
+    Projects data in a pool of worker processes.
+
+    Keyword arguments:
+    - tasks: list of (proj_args, proj_cache, n_jobs)
+    - pool: pool from get_pool(), its bundle must contain X_combined
+        (see projection.combine_data()) instead of X_train and X_test
+    - callback: see run_classifiers()
+
+    Returns:
+    - list of (title, error message) for failed projections
+    """
+    return _run_tasks(_project, tasks, pool, callback)
+
+
+def run_folds(tasks, pool):
+    """
+    Trains classifiers on cross validation folds in a pool of worker
+    processes. Exceptions in a worker are raised here.
+
+    Keyword arguments:
+    - tasks: list of (clf_args, fold, write_to_cache, max_memory)
+    - pool: pool from get_pool()
+
+    Returns:
+    - list of results of classification.classify_fold()
+        in the order of tasks
+    """
+    return pool.map(_classify_fold, tasks)
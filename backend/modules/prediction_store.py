@@ -0,0 +1,260 @@
+"""
+Columnar store for classifier predictions.
+
+For each dataset and prediction type (e.g. y_pred_proba_test) all
+classifiers' arrays are appended as rows to a single binary file,
+so they can be read as one contiguous, memory-mapped matrix.
+
+Files (all prefixed with the data hash):
+- {data_hash}__preds_meta.json     generation, dtype and row shape for each key
+- {data_hash}__preds_index         one classifier hash per line (= row)
+- {data_hash}__preds_{key}.bin     raw rows for each key
+
+compact() writes the remaining rows to files of a new generation
+({data_hash}__preds_{generation}_index etc.) and then switches to them
+by replacing the meta file, so an interrupted compaction leaves the
+store as it was. Readers hold a shared lock while they open the files,
+so the old generation is not deleted in between.
+"""
+
+from os.path import exists, getsize
+import json
+import numpy as np
+from termcolor import cprint
+from . import cache
+
+
+def _meta_file(data_hash):
+    return f'{data_hash}__preds_meta.json'
+
+
+def _index_file(data_hash, generation=0):
+    if generation == 0:
+        return f'{data_hash}__preds_index'
+    return f'{data_hash}__preds_{generation}_index'
+
+
+def _data_file(data_hash, key, generation=0):
+    if generation == 0:
+        return f'{data_hash}__preds_{key}.bin'
+    return f'{data_hash}__preds_{generation}_{key}.bin'
+
+
+def _read_meta(data_hash):
+    path = cache.get_path(_meta_file(data_hash))
+    if not exists(path):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    # stores that have never been compacted
+    if 'arrays' not in meta:
+        meta = {'generation': 0, 'arrays': meta}
+    return meta
+
+
+def read_index(data_hash, meta=None):
+    """
+    Returns the classifier hashes stored for a dataset in row order.
+    Pass meta only while holding the store's lock.
+    """
+    if meta is None:
+        # compact() must not switch generations while the index is read
+        with cache.lock(f'{data_hash}__preds', shared=True):
+            meta = _read_meta(data_hash)
+            if meta is None:
+                return []
+            return read_index(data_hash, meta)
+    path = cache.get_path(_index_file(data_hash, meta['generation']))
+    if not exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != '']
+
+
+def _row_bytes(meta_entry):
+    row_size = int(np.prod(meta_entry['row_shape'], dtype=np.int64))
+    return row_size * np.dtype(meta_entry['dtype']).itemsize
+
+
+def append(data_hash, clf_hash, arrays):
+    """
+    Appends the arrays of a classifier as new rows.
+
+    Keyword arguments:
+    - data_hash: hash of the dataset
+    - clf_hash: hash of the classifier (clf_cache)
+    - arrays: dictionary {key: array}
+
+    Returns:
+    - True if the arrays have been stored, False if they do not fit
+        the store (missing arrays, other shapes or types), the caller
+        has to store them elsewhere in that case
+    """
+    arrays = {k: None if v is None else np.asarray(v)
+              for k, v in arrays.items()}
+    if any(v is None or v.dtype == object for v in arrays.values()):
+        return False
+
+    # only one process changes the store of a dataset at a time
+    with cache.lock(f'{data_hash}__preds'):
+        # the first classifier defines the format of all rows
+        meta = _read_meta(data_hash)
+        if meta is None:
+            meta = {'generation': 0,
+                    'arrays': {k: {'dtype': v.dtype.str,
+                                   'row_shape': list(v.shape)}
+                               for k, v in arrays.items()}}
+            cache.write_dict_json(_meta_file(data_hash), meta,
+                                  add_extension=False)
+
+        specs = meta['arrays']
+        generation = meta['generation']
+        if set(specs.keys()) != set(arrays.keys()):
+            return False
+        for key, value in arrays.items():
+            dtype = np.dtype(specs[key]['dtype'])
+            # quantized probabilities must not be mixed with float ones
+            is_float = np.issubdtype(value.dtype, np.floating)
+            if list(value.shape) != specs[key]['row_shape'] \
+                    or is_float != np.issubdtype(dtype, np.floating) \
+                    or not np.can_cast(value.dtype, dtype, 'same_kind'):
+                return False
+
+        # the index is written last, so rows after the last indexed one
+        # are leftovers of an interrupted write and will be overwritten
+        n_rows = len(read_index(data_hash, meta))
+        for key, value in arrays.items():
+            dtype = np.dtype(specs[key]['dtype'])
+            path = cache.get_path(_data_file(data_hash, key, generation))
+            offset = n_rows * _row_bytes(specs[key])
+            mode = 'r+b' if exists(path) else 'wb'
+            with open(path, mode) as f:
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(np.ascontiguousarray(value, dtype=dtype).tobytes())
+
+        index_path = cache.get_path(_index_file(data_hash, generation))
+        with open(index_path, 'a') as index_file:
+            index_file.write(f'{clf_hash}\n')
+
+    cache.add_to_index([_data_file(data_hash, key, generation)
+                        for key in arrays]
+                       + [_index_file(data_hash, generation)])
+    return True
+
+
+def compact(data_hash):
+    """
+    Removes the rows of classifiers that are no longer in the cache
+    (deleted or interrupted before their result was written) and rows
+    that have been replaced by a later one for the same classifier.
+
+    Returns:
+    - number of removed rows
+    """
+    with cache.lock(f'{data_hash}__preds'):
+        meta = _read_meta(data_hash)
+        if meta is None:
+            return 0
+        index = read_index(data_hash, meta)
+        matrices = {key: _open_matrix(data_hash, key, meta, len(index))
+                    for key in meta['arrays']}
+        # rows missing in one of the data files are removed as well
+        n_found = min(0 if m is None else len(m) for m in matrices.values())
+        last_rows = {h: i for i, h in enumerate(index)}
+        rows = [i for i, h in enumerate(index[:n_found])
+                if last_rows[h] == i and cache.contains(h)]
+        removed = len(index) - len(rows)
+        if removed == 0:
+            return 0
+        if len(rows) == 0:
+            cache.delete(f'{data_hash}__preds_')
+            return removed
+
+        old_generation = meta['generation']
+        generation = old_generation + 1
+        for key, matrix in matrices.items():
+            cache.write_bytes(_data_file(data_hash, key, generation),
+                              np.ascontiguousarray(matrix[rows]).tobytes())
+        cache.write_plain(_index_file(data_hash, generation),
+                          ''.join(f'{index[i]}\n' for i in rows),
+                          add_extension=False)
+        # readers switch to the new files with the meta file
+        meta['generation'] = generation
+        cache.write_dict_json(_meta_file(data_hash), meta,
+                              add_extension=False)
+
+        for key in meta['arrays']:
+            cache.delete(_data_file(data_hash, key, old_generation))
+        cache.delete(_index_file(data_hash, old_generation))
+    cprint(f'Removed {removed} rows from the prediction store of {data_hash}',
+           'yellow')
+    return removed
+
+
+def _open_matrix(data_hash, key, meta, n_rows):
+    """
+    Returns the rows of one key memory-mapped, without rows missing
+    in the data file (e.g. after a crash), or None if there are none.
+    """
+    spec = meta['arrays'][key]
+    dtype = np.dtype(spec['dtype'])
+    row_shape = tuple(spec['row_shape'])
+    row_bytes = _row_bytes(spec)
+    if row_bytes == 0:
+        return np.zeros((n_rows,) + row_shape, dtype=dtype)
+    path = cache.get_path(_data_file(data_hash, key, meta['generation']))
+    if not exists(path):
+        return None
+    n_found = min(n_rows, getsize(path) // row_bytes)
+    if n_found < n_rows:
+        cprint(f'Prediction store for {data_hash} is incomplete!', 'red')
+    if n_found == 0:
+        return None
+    return np.memmap(path, dtype=dtype, mode='r',
+                     shape=(n_found,) + row_shape)
+
+
+def read(data_hash, clf_hashes, key):
+    """
+    Reads the rows of multiple classifiers for one key.
+
+    Keyword arguments:
+    - data_hash: hash of the dataset
+    - clf_hashes: list of classifier hashes
+    - key: name of the array, e.g. y_pred_proba_test
+
+    Returns:
+    - matrix with shape (num_found, *row_shape) in the order of clf_hashes,
+        memory-mapped if the rows are stored contiguously and in order,
+        or None if nothing was found
+    - list of classifier hashes that are not in the store
+    """
+    # compact() deletes the files of the old generation, files that are
+    # memory-mapped while holding the lock can still be read afterwards
+    with cache.lock(f'{data_hash}__preds', shared=True):
+        meta = _read_meta(data_hash)
+        if meta is None or key not in meta['arrays']:
+            return None, list(clf_hashes)
+        index = read_index(data_hash, meta)
+        matrix = _open_matrix(data_hash, key, meta, len(index))
+    if matrix is None:
+        return None, list(clf_hashes)
+
+    # later rows replace earlier ones for the same classifier
+    rows_by_hash = {h: i for i, h in enumerate(index)}
+    rows = []
+    missing = []
+    for h in clf_hashes:
+        if h in rows_by_hash and rows_by_hash[h] < len(matrix):
+            rows.append(rows_by_hash[h])
+        else:
+            missing.append(h)
+    if len(rows) == 0:
+        return None, missing
+
+    # a contiguous range can be returned as a view without copying
+    start = rows[0]
+    if rows == list(range(start, start + len(rows))):
+        return matrix[start:start + len(rows)], missing
+    return matrix[rows], missing
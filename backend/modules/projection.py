@@ -2,20 +2,26 @@ from sklearn.decomposition import PCA
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn import manifold
 import umap
-from . import tools, cache, classification
+from . import tools, cache, classification, distance_matrix
 from .tools import check_arg as check
 import numpy as np
-from scipy.spatial import distance
 from termcolor import cprint
 import json
 
 
-def get_projection(args):
+# projection methods that can be fitted on a precomputed distance matrix
+PRECOMPUTED_METHODS = ('mds', 'tsne')
+
+
+def get_projection(args, precomputed=False, n_jobs=-1):
     """
     Returns a projection as specified in args.
 
     Keyword arguments:
     - args: arguments as dict
+    - precomputed: if True, the projection expects a distance matrix
+        instead of data, only for methods in PRECOMPUTED_METHODS
+    - n_jobs: number of processors for methods that support it
 
     Returns:
     - a projection object with fit_transform(X) method
@@ -27,17 +33,23 @@ def get_projection(args):
 
     # does not work when flask (main.py) is used, only with batch_job.py
     # -1 means using all processors
-    jobs = -1
+    jobs = n_jobs
     n_components = 2
 
+    if precomputed and method not in PRECOMPUTED_METHODS:
+        raise Exception(
+            f'Projection method "{method}" does not support precomputed distances!')
+
     if method == 'pca':
         return PCA(n_components,
                    random_state=random_state)
 
     elif method == 'mds':
+        dissimilarity = 'precomputed' if precomputed else 'euclidean'
         return manifold.MDS(n_components,
                             random_state=random_state,
-                            n_jobs=jobs)
+                            n_jobs=jobs,
+                            dissimilarity=dissimilarity)
 
     elif method == 'isomap':
         n_neighbors = check('n_neighbors', args['n_neighbors'], int, (1, 1000))
@@ -53,6 +65,13 @@ def get_projection(args):
     elif method == 'tsne':
         perplexity = check('perplexity', args['perplexity'], float, (1, 100))
         # return manifold.TSNE(n_components=n_components, perplexity=perplexity, verbose=2, random_state=random_state)
+        if precomputed:
+            # PCA initialization is not possible without the data
+            return manifold.TSNE(n_components=n_components,
+                                 perplexity=perplexity,
+                                 random_state=random_state,
+                                 metric='precomputed',
+                                 init='random')
         return manifold.TSNE(n_components=n_components,
                              perplexity=perplexity,
                              random_state=random_state)
@@ -92,7 +111,19 @@ def get_projection(args):
         raise Exception(f'Invalid projection method parameter "{method}"!')
 
 
-def project(proj_args, proj_cache, data_bundle):
+def combine_data(data_bundle):
+    """
+    Returns training and test data combined into a single array,
+    projections are fitted on both.
+    """
+    X_train = data_bundle['X_train']
+    X_test = data_bundle['X_test']
+    if len(X_test) == 0:
+        return X_train
+    return np.concatenate((X_train, X_test), axis=0)
+
+
+def project(proj_args, proj_cache, data_bundle, X_combined=None, n_jobs=-1):
     """
     Projects the data.
 
@@ -101,26 +132,40 @@ def project(proj_args, proj_cache, data_bundle):
     - proj_cache: hash of the projection args
     - data_bundle: data to project given as dict
         (format as output from dataset plugins)
+    - X_combined: output of combine_data(data_bundle), pass it when
+        projecting the same data multiple times to avoid copying it
+    - n_jobs: number of processors for methods that support it
 
     Side effects:
     - caches the projection
     """
+    # another process (e.g. a second request for the same projection)
+    # may be projecting the same data, wait for it instead of repeating it
+    with cache.lock(proj_cache):
+        if cache.contains(proj_cache):
+            cprint('Projection has been cached by another process', 'green')
+            return
+        _project(proj_args, proj_cache, data_bundle, X_combined, n_jobs)
+
+
+def _project(proj_args, proj_cache, data_bundle, X_combined, n_jobs):
+    """
+    Projects the data without checking the cache, see project().
+    """
     if 'title' in proj_args:
         cprint(f'  Title: {proj_args["title"]}', 'cyan')
     print(f'  Method: {proj_args["method"]} ...')
     print(f'  Args:\n{json.dumps(proj_args, sort_keys=False, indent=4)}')
     try:
-        proj = get_projection(proj_args)
+        proj = get_projection(proj_args, n_jobs=n_jobs)
 
         X_train = data_bundle['X_train']
         X_test = data_bundle['X_test']
 
         # fit on train and test (therefore combine them)
         train_len = len(X_train)
-        if len(X_test) == 0:
-            X_combined = X_train
-        else:
-            X_combined = np.concatenate((X_train, X_test), axis=0)
+        if X_combined is None:
+            X_combined = combine_data(data_bundle)
 
         # transform together
         transformed = proj.fit_transform(X_combined)
@@ -133,9 +178,9 @@ def project(proj_args, proj_cache, data_bundle):
         proj_bundle = {
             'type': 'data',
             'hash': data_bundle['hash'],
-            'X_train': tools.tolist(X_train_trans),
+            'X_train': cache.compact_coordinates(X_train_trans),
             'y_train': tools.tolist(data_bundle['y_train']),
-            'X_test': tools.tolist(X_test_trans),
+            'X_test': cache.compact_coordinates(X_test_trans),
             'y_test': tools.tolist(data_bundle['y_test']),
             'class_names': tools.tolist(data_bundle['class_names']),
             'shape_train': X_train.shape,
@@ -152,7 +197,27 @@ def project(proj_args, proj_cache, data_bundle):
         raise
 
 
-def get_clf_distances(data_flat, distance_function='euclidean'):
+def project_precomputed(proj_args, distances):
+    """
+    Projects items given by their full (square) distance matrix.
+
+    Keyword arguments:
+    - proj_args: projection arguments as dict, the method must be
+        in PRECOMPUTED_METHODS
+    - distances: square euclidean distance matrix
+
+    Returns:
+    - transformed data
+    """
+    proj = get_projection(proj_args, precomputed=True)
+    if proj_args['method'] == 'tsne':
+        # t-SNE uses squared euclidean distances by default
+        return proj.fit_transform(np.square(distances))
+    return proj.fit_transform(distances)
+
+
+def get_clf_distances(data_flat, distance_function='euclidean', n_jobs=1,
+                      condensed=False, normalize=True, raise_errors=False):
     """
     Computes the distance matrix between all classifiers
     (their predictions, probabilities, ...) given as an array
@@ -167,55 +232,38 @@ def get_clf_distances(data_flat, distance_function='euclidean'):
     - data_flat: 2D array with shape (num_clfs, num_values_per_clf)
     - distance_function: distance function, one of euclidean, cosine,
         correlation, hamming
+    - n_jobs: number of threads used to compute blocks of the matrix
+    - condensed: if True, the condensed float32 array is returned
+        (see distance_matrix.pairwise_distances) instead of the
+        lower-triangular list
+    - normalize: if False, distances are not normalized
+    - raise_errors: if False, all distances are 0 when they cannot be
+        calculated
 
     Returns:
     - distances: distance matrix, normalized to [0, 1]
     """
     print(f'  Calculating distances with metric {distance_function}')
+    n = len(data_flat)
     try:
-        distances = []
-        max_dist = 0
-        n = range(len(data_flat))
-        # calculate distance matrix
-        distances = []
-        for i in n:
-            # do not create the full matrix (since it is symmetric)
-            row = [0 for _ in range(i)]
-            distances.append(row)
-            d_i = data_flat[i]
-            for j in n:
-                if i > j:
-                    try:
-                        if distance_function == 'euclidean':
-                            dist = distance.euclidean(d_i, data_flat[j])
-                        elif distance_function == 'cosine':
-                            dist = distance.cosine(d_i, data_flat[j])
-                        elif distance_function == 'correlation':
-                            dist = distance.correlation(d_i, data_flat[j])
-                        elif distance_function == 'hamming':
-                            dist = distance.hamming(d_i, data_flat[j])
-                        distances[i][j] = dist
-                        if dist > max_dist:
-                            max_dist = dist
-                    except:
-                        # TODO:fix bug with some data
-                        # print(d_i)
-                        # print(data_flat[j])
-                        # print(d_i.shape)
-                        # print(data_flat[j].shape)
-                        # print(i, j)
-                        raise
-        # normalize distances to [0, 1]
-        if max_dist > 0:
-            distances = [[x / max_dist for x in row] for row in distances]
-        return distances
+        distances = distance_matrix.pairwise_distances(data_flat,
+                                                       distance_function,
+                                                       n_jobs=n_jobs)
+        if normalize:
+            distance_matrix.normalize(distances)
     except Exception as e:
         cprint('Projection.py get_clfs_distances: Cannot calculate distances!', 'red')
         cprint(e, 'red')
-        return [[0 for _ in range(i)] for i in n]
+        if raise_errors:
+            raise
+        distances = np.zeros(distance_matrix.condensed_size(n),
+                             dtype=np.float32)
+    if condensed:
+        return distances
+    return distance_matrix.to_lower_triangular(distances)
 
 
-def all_clf_projections_cached(confs, base_conf, data_cache, cache_entries):
+def all_clf_projections_cached(confs, base_conf, data_cache):
     """
     Checks if all classifier projections are already cached
     """
@@ -229,7 +277,7 @@ def all_clf_projections_cached(confs, base_conf, data_cache, cache_entries):
                 clf_proj_args['projection']['random_state'] = 42
                 # check cache
                 clf_proj_cache = f'{data_cache}__clf_proj_{tools.hash(clf_proj_args)}'
-                if clf_proj_cache not in cache_entries:
+                if not cache.contains(clf_proj_cache):
                     return False
     return True
 
@@ -270,7 +318,6 @@ def batch_project_classifiers(args):
 
     # create all projection configs and check cache for all of them
     projs = []
-    cache_entries = cache.entries()
     base_conf = {
         'action': 'project_classifiers',
         'classifier_hashes': classifiers,
@@ -281,7 +328,7 @@ def batch_project_classifiers(args):
     }
 
     all_cached = all_clf_projections_cached(
-        confs, base_conf, args["data_hash"], cache_entries)
+        confs, base_conf, args["data_hash"])
 
     # read clfs and and optimal clf if projections are not all cached already
     if not all_cached:
@@ -290,15 +337,17 @@ def batch_project_classifiers(args):
         clfs = []
         current = 1
         for c in classifiers:
-            # read clf bundle and prediction bundle
-            clf = cache.read(c)
-            pred = cache.read(f'{c}_proba')
-            # merge bundles
-            clf = {**clf, **pred}
-            clfs.append(clf)
+            # read clf bundle
+            clfs.append(cache.read(c))
             print(current, end='\r')
             current += 1
 
+        # read predictions of all classifiers as matrices
+        pred_proba = {}
+        for key in ['y_pred_proba_test', 'y_pred_proba_train']:
+            pred_proba[key] = classification.read_prediction_matrix(
+                args['data_hash'], classifiers, key)
+
     # create all projections that are missing
     errors = 0
     done = 0
@@ -318,26 +367,32 @@ def batch_project_classifiers(args):
                             c['pred_time']
                         ])
                 elif data_type == 'pred_proba':
-                    data = [c['y_pred_proba_test'] for c in clfs]
+                    data = pred_proba['y_pred_proba_test']
                 else:
                     raise Exception(
                         f'Wrong data type! Must be in ["scores", "conf_matrix", "pred_proba", "pred"] but was {data_type}')
-                data = np.array(data)
+                data = np.asarray(data)
                 data = data.reshape(data.shape[0], -1)
                 if use_train:
                     # append training predictions to each test prediction
                     if data_type == 'scores':
                         data2 = []
-                        for c in clfs:
-                            data2.append([
-                                c['train_scores']['accuracy'],
-                                c['clf_time']
-                            ])
+                        # without training predictions there are no scores
+                        if all(c['train_scores']['accuracy'] is not None for c in clfs):
+                            for c in clfs:
+                                data2.append([
+                                    c['train_scores']['accuracy'],
+                                    c['clf_time']
+                                ])
+                        else:
+                            data2 = np.zeros((len(clfs), 0))
                     else:
-                        data2 = [c['y_pred_proba_train'] for c in clfs]
-                    data2 = np.array(data2)
+                        data2 = pred_proba['y_pred_proba_train']
+                    data2 = np.asarray(data2)
                     data2 = data2.reshape(data2.shape[0], -1)
-                    # fix errors with cross validation
+                    # cross validation and train_prediction 'none' do not
+                    # store training predictions, with 'sample' all
+                    # classifiers have predictions for the same samples
                     if data2.shape[1] > 1:
                         data = np.concatenate((data, data2), axis=1)
                     else:
@@ -347,8 +402,24 @@ def batch_project_classifiers(args):
                 # flatten data to get a vector
                 data_flat = data.reshape(data.shape[0], -1)
 
-                # get distances
-                distances = get_clf_distances(data_flat)
+                # get distances once, they are used for the clf map and
+                # by all projections that support precomputed distances
+                try:
+                    raw_distances = get_clf_distances(data_flat,
+                                                      condensed=True,
+                                                      normalize=False,
+                                                      raise_errors=True)
+                    square_distances = distance_matrix.to_square(
+                        raw_distances).astype(np.float64)
+                    distances = distance_matrix.to_lower_triangular(
+                        distance_matrix.normalize(raw_distances))
+                except Exception:
+                    # all projections work on the data instead, the
+                    # clf map gets a matrix of zeros as before
+                    square_distances = None
+                    distances = distance_matrix.to_lower_triangular(
+                        np.zeros(distance_matrix.condensed_size(
+                            len(data_flat)), dtype=np.float32))
 
             # run all projections for the current data_type and use_train values
             for clf_proj in confs['projections']:
@@ -365,7 +436,7 @@ def batch_project_classifiers(args):
 
                 clf_proj_cache = f'{args["data_hash"]}__clf_proj_{tools.hash(clf_proj_args)}'
 
-                if clf_proj_cache in cache_entries:
+                if cache.contains(clf_proj_cache):
                     projs.append(cache.read(clf_proj_cache))
                     cached += 1
                 else:
@@ -373,8 +444,13 @@ def batch_project_classifiers(args):
                         # project
                         cprint(
                             f'Projecting with: {clf_proj["method"]}', 'cyan')
-                        proj = get_projection(clf_proj)
-                        transformed = proj.fit_transform(data_flat)
+                        if clf_proj['method'] in PRECOMPUTED_METHODS \
+                                and square_distances is not None:
+                            transformed = project_precomputed(
+                                clf_proj, square_distances)
+                        else:
+                            proj = get_projection(clf_proj)
+                            transformed = proj.fit_transform(data_flat)
 
                         clf_proj_bundle = {
                             'type': 'projected_classifiers',
@@ -0,0 +1,228 @@
+"""
+Resource-aware scheduling of classifiers.
+
+Each classifier plugin may give hints on the resources it needs in
+CLF_INFO['resources'] (threads, memory, accelerator). Tasks are started
+as soon as they fit into the budget of processors, memory and GPU
+slots, so heavy TensorFlow models with a limited number of threads can
+run alongside lightweight single-threaded scikit-learn models.
+
+All tasks share one pool with a worker process per processor, the
+numerical libraries of a worker are limited to the number of threads
+of the task it is running.
+"""
+
+import os
+from queue import Queue
+from time import time
+from . import parallel
+from .classifiers import get_classifier_resources
+
+# used for all hints a plugin does not specify
+DEFAULT_RESOURCES = {
+    'threads': 1,
+    # MB in addition to the data
+    'memory': 256,
+    'accelerator': None
+}
+
+
+def get_machine_resources():
+    """
+    Returns:
+    - number of processors this process may use
+    - physical memory in MB or None if unknown
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * \
+            os.sysconf('SC_PHYS_PAGES') // 2**20
+    except (AttributeError, ValueError, OSError):
+        memory = None
+    return cpus, memory
+
+
+def get_task_resources(clf_args, data_memory=0, cpus=None):
+    """
+    Returns the resources a classifier needs.
+
+    Keyword arguments:
+    - clf_args: classifier arguments as in batch jobs
+    - data_memory: size of the data in MB, most classifiers
+        create at least one copy of it
+    - cpus: if given, the number of threads is limited to this
+    """
+    hints = get_classifier_resources(clf_args['method'])
+    resources = dict(DEFAULT_RESOURCES)
+    resources.update({k: v for k, v in hints.items()
+                      if k in DEFAULT_RESOURCES})
+    threads = max(1, int(resources['threads']))
+    if cpus is not None:
+        threads = min(threads, cpus)
+    return {
+        'threads': threads,
+        'memory': resources['memory'] + data_memory,
+        'accelerator': resources['accelerator']
+    }
+
+
+def run_classifiers(tasks, shared, cpus, memory=None, gpus=None, callback=None,
+                    max_memory=None):
+    """
+    Trains classifiers in worker processes and runs as many of them
+    at the same time as fit into the budget.
+    Tasks that are larger than the whole budget run alone.
+
+    Keyword arguments:
+    - tasks: list of (clf_args, clf_cache, resources),
+        resources as returned by get_task_resources()
+    - shared: output of parallel.export_bundle()
+    - cpus: number of processors
+    - memory: memory in MB or None for no limit
+    - gpus: number of tasks with accelerator 'gpu' that may run
+        at the same time or None for no limit
+    - callback: called with (title, error) for each finished task,
+        may raise an exception to stop all remaining tasks
+    - max_memory: memory limit for predictions of each classifier in bytes
+        (see classification.classify()), not part of the memory budget
+
+    Returns:
+    - list of (title, error message) for failed classifiers
+    - utilization report as returned by get_utilization()
+    """
+    budget = {'threads': cpus, 'memory': memory, 'gpus': gpus}
+    used = {'threads': 0, 'memory': 0, 'gpus': 0}
+    # start heavy tasks first, lightweight tasks fill the gaps
+    pending = sorted(range(len(tasks)), reverse=True,
+                     key=lambda i: (tasks[i][2]['accelerator'] is not None,
+                                    tasks[i][2]['threads'],
+                                    tasks[i][2]['memory']))
+    running = {}
+    records = []
+    errors = []
+    # every running task reserves at least one processor, except for
+    # a task that is larger than the budget and runs alone
+    pool = parallel.get_pool(max(1, min(cpus, len(tasks))), shared)
+    finished = Queue()
+    t_start = time()
+
+    def fits(resources):
+        # something has to run, even if it is too large
+        if len(running) == 0:
+            return True
+        for key, needed in _needed(resources).items():
+            if budget[key] is not None and used[key] + needed > budget[key]:
+                return False
+        return True
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # start all tasks that fit
+            for i in list(pending):
+                resources = tasks[i][2]
+                if not fits(resources):
+                    continue
+                pending.remove(i)
+                for key, needed in _needed(resources).items():
+                    used[key] += needed
+                running[i] = time()
+                pool.apply_async(
+                    parallel.classify_measured,
+                    ((i, tasks[i][0], tasks[i][1], resources['threads'],
+                      max_memory),),
+                    callback=finished.put,
+                    error_callback=lambda e, i=i: finished.put(
+                        (i, tasks[i][0]['title'], str(e), 0)))
+
+            # wait for the next task to finish
+            i, title, error, cpu_time = finished.get()
+            resources = tasks[i][2]
+            for key, needed in _needed(resources).items():
+                used[key] -= needed
+            records.append(dict(resources,
+                                title=title,
+                                start=running.pop(i) - t_start,
+                                end=time() - t_start,
+                                cpu_time=cpu_time))
+            if error is not None:
+                errors.append((title, error))
+            if callback is not None:
+                callback(title, error)
+
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    return errors, get_utilization(records, cpus, memory, time() - t_start)
+
+
+def _needed(resources):
+    return {
+        'threads': resources['threads'],
+        'memory': resources['memory'],
+        'gpus': 1 if resources['accelerator'] == 'gpu' else 0
+    }
+
+
+def get_utilization(records, cpus, memory, wall_time):
+    """
+    Summarizes how well tasks used the budget.
+
+    Keyword arguments:
+    - records: list of dicts with threads, memory, accelerator,
+        start, end (seconds since the start) and cpu_time
+    - cpus: number of processors in the budget
+    - memory: memory budget in MB or None
+    - wall_time: total time in seconds
+
+    Returns:
+    - dict with
+        tasks: number of tasks
+        wall_time: total time in seconds
+        cpu_reserved: fraction of processor time reserved for tasks
+        cpu_used: fraction of processor time actually used by tasks
+        peak_tasks: maximum number of tasks running at the same time
+        peak_threads: maximum number of reserved threads
+        peak_memory: maximum reserved memory in MB
+        memory_budget: memory budget in MB or None
+        gpu_busy: fraction of time at least one GPU task was running
+    """
+    available = max(cpus * wall_time, 1e-9)
+    reserved = sum(r['threads'] * (r['end'] - r['start']) for r in records)
+    cpu_used = sum(r['cpu_time'] for r in records)
+
+    # sweep over start and end events, ends before starts at equal times
+    events = sorted([(r['start'], 1, r) for r in records]
+                    + [(r['end'], -1, r) for r in records],
+                    key=lambda e: (e[0], e[1]))
+    tasks = threads = mem = gpu_tasks = 0
+    peak_tasks = peak_threads = peak_memory = 0
+    gpu_busy = 0
+    last_t = 0
+    for t, sign, r in events:
+        if gpu_tasks > 0:
+            gpu_busy += t - last_t
+        last_t = t
+        tasks += sign
+        threads += sign * r['threads']
+        mem += sign * r['memory']
+        gpu_tasks += sign * (r['accelerator'] == 'gpu')
+        peak_tasks = max(peak_tasks, tasks)
+        peak_threads = max(peak_threads, threads)
+        peak_memory = max(peak_memory, mem)
+
+    return {
+        'tasks': len(records),
+        'wall_time': wall_time,
+        'cpu_reserved': reserved / available,
+        'cpu_used': cpu_used / available,
+        'peak_tasks': peak_tasks,
+        'peak_threads': peak_threads,
+        'peak_memory': peak_memory,
+        'memory_budget': memory,
+        'gpu_busy': gpu_busy / max(wall_time, 1e-9)
+    }
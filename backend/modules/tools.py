@@ -4,10 +4,7 @@ from termcolor import colored, cprint
 from datetime import datetime
 import sys
 import math
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import precision_recall_fscore_support
-from sklearn.metrics import classification_report
+import numpy as np
 from . import cache
 
 
@@ -167,6 +164,17 @@ def tolist(listlike):
         return listlike.tolist()
 
 
+def classes_from_proba(y_prob):
+    """
+    Returns the class labels for the output of a Keras model,
+    the same as model.predict_classes() but without predicting again.
+    """
+    y_prob = np.asarray(y_prob)
+    if y_prob.shape[-1] > 1:
+        return y_prob.argmax(axis=-1)
+    return (y_prob > 0.5).astype('int32')
+
+
 def hash(args, prefix=''):
     """
     Generates a prefixed hash of a dictionary.
@@ -194,44 +202,108 @@ def print_time_elapsed(t0, prefix='', end=''):
     print(f'{prefix} Time: {now} elapsed: {elapsed} ', end=end)
 
 
-def add_vector(vector1, vector2):
+def get_confusion_matrix(y_true, y_pred, num_classes=0):
     """
-    Adds vector1 and vector2 component-wise
+    Computes the confusion matrix with a single np.bincount.
+
+    Labels that are integers in [0, num_classes) are used as indices,
+    so the matrix has a row and column for every class, even if it
+    does not occur. Other labels are encoded in sorted order.
+
+    Returns:
+    - confusion matrix with shape (n_labels, n_labels),
+        rows are true labels, columns predicted labels
     """
-    summed = [x for x in vector1]
-    for i in range(len(vector1)):
-        summed[i] += vector2[i]
-    return summed
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
+    both = np.concatenate((y_true, y_pred))
+    is_index = np.issubdtype(both.dtype, np.integer) and len(both) > 0 \
+        and both.min() >= 0 and both.max() < num_classes
+    if is_index:
+        n_labels = num_classes
+    else:
+        _, both = np.unique(both, return_inverse=True)
+        n_labels = int(both.max()) + 1 if len(both) > 0 else 0
+        y_true = both[:len(y_true)]
+        y_pred = both[len(y_true):]
+    counts = np.bincount(y_true * n_labels + y_pred,
+                         minlength=n_labels * n_labels)
+    return counts.reshape(n_labels, n_labels)
 
 
-def add_matrix(matrix1, matrix2):
+def _weighted_pre_rec_fs(true_positives, predicted, actual):
     """
-    Adds matrix2 to matrix1 in place
+    Returns precision, recall and F1 score averaged over labels,
+    weighted by the number of true instances of each label.
+    Undefined values (division by zero) count as 0.
     """
-    size = len(matrix1)
-    for i in range(size):
-        for j in range(size):
-            matrix1[i][j] += matrix2[i][j]
-    return matrix1
+    def divide(a, b):
+        return np.divide(a, b, out=np.zeros(len(a)), where=b != 0)
+
+    precision = divide(true_positives, predicted)
+    recall = divide(true_positives, actual)
+    f_score = divide(2 * precision * recall, precision + recall)
+    total = actual.sum()
+    if total == 0:
+        return [0.0, 0.0, 0.0]
+    weights = actual / total
+    return [float(np.dot(weights, precision)),
+            float(np.dot(weights, recall)),
+            float(np.dot(weights, f_score))]
 
 
 def get_scores(y_true, y_pred, class_names):
     """
     Calculates various classifier scores.
+
+    For single-label data, everything is derived from the confusion matrix.
+    For multi-label data (label indicator matrices), accuracy is the
+    fraction of samples where all labels are correct and there is no
+    confusion matrix.
+
+    Returns:
+    - dict with accuracy, conf_matrix and pre_rec_fs_supp,
+        the latter is [precision, recall, F1, None] weighted by support
     """
-    conf_matrix = None
-    try:
-        conf_matrix = tolist(confusion_matrix(y_true, y_pred))
-    except Exception as e:
-        # TODO: handle multi-label here
-        cprint('Cannot calculate confusion matrix (disabled for multi-label)', 'yellow')
-        cprint(e, 'yellow')
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+
+    if y_true.ndim == 2 and y_true.shape[1] > 1:
+        # multi-label
+        y_true = y_true != 0
+        y_pred = y_pred.reshape(y_true.shape) != 0
+        true_positives = np.count_nonzero(y_true & y_pred, axis=0)
+        accuracy = float(np.mean(np.all(y_true == y_pred, axis=1)))
+        pre_rec_fs = _weighted_pre_rec_fs(true_positives,
+                                          np.count_nonzero(y_pred, axis=0),
+                                          np.count_nonzero(y_true, axis=0))
+        conf_matrix = None
+    else:
+        conf_matrix = get_confusion_matrix(y_true, y_pred, len(class_names))
+        true_positives = np.diag(conf_matrix)
+        accuracy = float(true_positives.sum() / max(1, conf_matrix.sum()))
+        pre_rec_fs = _weighted_pre_rec_fs(true_positives,
+                                          conf_matrix.sum(axis=0),
+                                          conf_matrix.sum(axis=1))
+        conf_matrix = conf_matrix.tolist()
 
     return {
-        'accuracy': accuracy_score(y_true, y_pred),
+        'accuracy': accuracy,
         'conf_matrix': conf_matrix,
-        'pre_rec_fs_supp': precision_recall_fscore_support(
-            y_true, y_pred, average='weighted')
+        # support is None when averaging, as in scikit-learn
+        'pre_rec_fs_supp': pre_rec_fs + [None]
+    }
+
+
+def get_empty_scores():
+    """
+    Returns scores with the same structure as get_scores() but
+    without values, for data that has not been predicted.
+    """
+    return {
+        'accuracy': None,
+        'conf_matrix': None,
+        'pre_rec_fs_supp': [None, None, None, None]
     }
 
 
@@ -239,28 +311,25 @@ def get_mean_scores(scores):
     """
     Calculates the mean of all scores
     """
-    num = len(scores)
-    acc = scores[0]['accuracy']
-    conf_matrix = scores[0]['conf_matrix']
-    pre_rec_fs_supp = scores[0]['pre_rec_fs_supp'][:3]
-
-    # add
-    for i in range(1, num):
-        score = scores[i]
-        acc += score['accuracy']
-        conf_matrix = add_matrix(conf_matrix, score['conf_matrix'])
-        pre_rec_fs_supp = add_vector(
-            pre_rec_fs_supp, score['pre_rec_fs_supp'][:3])
-
-    # divide by num
-    acc /= num
-    conf_matrix = [[round(x/num, 1) for x in row] for row in conf_matrix]
-    pre_rec_fs_supp = [x/num for x in pre_rec_fs_supp]
+    # a mean is only meaningful if all scores are given
+    if any(score['accuracy'] is None for score in scores):
+        return get_empty_scores()
+
+    accuracy = float(np.mean([score['accuracy'] for score in scores]))
+    pre_rec_fs = np.mean([score['pre_rec_fs_supp'][:3] for score in scores],
+                         axis=0)
+
+    # confusion matrices can only be averaged if all have the same shape
+    conf_matrices = [score['conf_matrix'] for score in scores]
+    conf_matrix = None
+    if all(m is not None for m in conf_matrices) \
+            and len(set(np.shape(m) for m in conf_matrices)) == 1:
+        conf_matrix = np.mean(conf_matrices, axis=0).round(1).tolist()
 
     return {
-        'accuracy': acc,
+        'accuracy': accuracy,
         'conf_matrix': conf_matrix,
-        'pre_rec_fs_supp': pre_rec_fs_supp
+        'pre_rec_fs_supp': pre_rec_fs.tolist()
     }
 
 
@@ -0,0 +1,287 @@
+"""
+Serialization of API responses.
+
+JSON is encoded with orjson if it is installed, which writes NumPy
+arrays directly instead of converting them to lists first.
+
+The binary format is an alternative to JSON for responses with
+large arrays (projected coordinates, distances).
+
+Responses are compressed with zstd, brotli or gzip, depending on
+what the client accepts and which packages are installed.
+
+Layout (all numbers little-endian):
+- magic bytes b'NDAB'
+- uint32: length of the header in bytes
+- header: UTF-8 JSON {"data": ..., "arrays": [...]}, padded with spaces
+    so the first array starts at a multiple of 8 bytes
+- the raw arrays, each padded to a multiple of 8 bytes
+
+In "data", every array is replaced by {"__array__": i}, where i is the
+position in "arrays". Each entry of "arrays" has dtype (NumPy type
+string), shape and offset (from the end of the padded header).
+Only types that have a JavaScript typed array are used, so browsers can
+create views on the response without copying.
+"""
+
+import gzip
+import json
+import struct
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    # the standard library is used instead, which is much slower
+    orjson = None
+
+# optional compressors, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'NDAB'
+MIME_TYPE = 'application/x-ndarray-bundle'
+FORMATS = ('json', 'binary')
+
+# lists with fewer numbers are kept in the JSON header
+MIN_ARRAY_SIZE = 64
+
+# content codings in order of preference
+ENCODINGS = ('zstd', 'br', 'gzip')
+
+# smaller responses are not compressed
+MIN_COMPRESS_SIZE = 1024
+
+# types that are converted, since JavaScript has no typed array for them
+_CONVERSIONS = {
+    np.dtype(np.float16): np.float32,
+    np.dtype(np.bool_): np.uint8,
+    np.dtype(np.int64): np.int32,
+    np.dtype(np.uint64): np.uint32
+}
+
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+
+def _prepare_array(array):
+    """
+    Returns a little-endian, contiguous array of a type JavaScript supports.
+    """
+    dtype = _CONVERSIONS.get(array.dtype)
+    if dtype is not None and np.issubdtype(dtype, np.integer) and array.size > 0:
+        # integers that do not fit into 32 bit are sent as floats
+        info = np.iinfo(dtype)
+        if array.min() < info.min or array.max() > info.max:
+            dtype = np.float64
+    if dtype is not None:
+        array = array.astype(dtype)
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+
+
+def _as_array(value):
+    """
+    Returns a numeric list as array, None if it is too small,
+    ragged or contains other values than numbers.
+    """
+    first = value
+    while isinstance(first, (list, tuple)) and len(first) > 0:
+        first = first[0]
+    if isinstance(first, (bool, str)) or not isinstance(first, (int, float, np.number)):
+        return None
+    try:
+        array = np.asarray(value)
+    except ValueError:
+        return None
+    if array.dtype.kind not in 'fiub' or array.size < MIN_ARRAY_SIZE:
+        return None
+    return array
+
+
+def get_encoding(accept_encoding):
+    """
+    Returns the preferred encoding that is installed and accepted by the
+    client (according to an Accept-Encoding header) or None.
+    """
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        accepted[coding.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) <= 0:
+            continue
+        if encoding == 'zstd' and zstandard is None:
+            continue
+        if encoding == 'br' and brotli is None:
+            continue
+        return encoding
+    return None
+
+
+def compress(body, encoding, level=None):
+    """
+    Compresses a response body.
+
+    Keyword arguments:
+    - body: bytes
+    - encoding: one of ENCODINGS
+    - level: compression level or None for the encoding's default
+
+    Returns:
+    - compressed bytes
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3).compress(body)
+    if encoding == 'br':
+        return brotli.compress(body, quality=level or 5)
+    if encoding == 'gzip':
+        # without a time stamp the output is the same for the same body
+        return gzip.compress(body, compresslevel=level or 6, mtime=0)
+    raise Exception(f'Invalid encoding "{encoding}", must be in {ENCODINGS}')
+
+
+def encode_json(data, decimals=None):
+    """
+    Encodes data (dicts, lists, numbers, strings and NumPy arrays) as JSON.
+
+    Keyword arguments:
+    - data: data to encode
+    - decimals: if given, floats in arrays are rounded to this number
+        of decimals, which makes the response smaller
+
+    Returns:
+    - bytes
+    """
+    if decimals is not None:
+        data = _round_arrays(data, decimals)
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY
+                            | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_json_default).encode('utf-8')
+
+
+def _json_default(value):
+    """
+    Converts values that the JSON encoder does not support.
+    """
+    if isinstance(value, np.ndarray):
+        if orjson is None:
+            return value.tolist()
+        # orjson supports only contiguous arrays of some types
+        if value.dtype == np.float16:
+            return value.astype(np.float32)
+        if value.dtype.kind in 'fiub' and not value.flags['C_CONTIGUOUS']:
+            return np.ascontiguousarray(value)
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f'Cannot encode {type(value)} as JSON')
+
+
+def _round_arrays(value, decimals):
+    """
+    Returns data with rounded float arrays, lists of numbers are not
+    walked and kept as they are.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype == np.float16:
+            value = value.astype(np.float32)
+        if value.dtype.kind == 'f':
+            return np.round(value, decimals)
+        return value
+    if isinstance(value, dict):
+        return {k: _round_arrays(v, decimals) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and len(value) > 0 \
+            and isinstance(value[0], (dict, list, tuple, np.ndarray)):
+        return [_round_arrays(v, decimals) for v in value]
+    return value
+
+
+def encode(data):
+    """
+    Encodes data (dicts, lists, numbers, strings and NumPy arrays)
+    in the binary format, large lists of numbers are sent as arrays.
+
+    Returns:
+    - bytes
+    """
+    arrays = []
+
+    def replace(value):
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'fiub':
+            arrays.append(_prepare_array(value))
+            return {'__array__': len(arrays) - 1}
+        if isinstance(value, dict):
+            return {str(k): replace(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            array = _as_array(value)
+            if array is not None:
+                return replace(array)
+            return [replace(v) for v in value]
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    tree = replace(data)
+    specs = []
+    offset = 0
+    for a in arrays:
+        specs.append({'dtype': a.dtype.str,
+                      'shape': list(a.shape),
+                      'offset': offset})
+        offset = _align(offset + a.nbytes)
+    header = json.dumps({'data': tree, 'arrays': specs}).encode('utf-8')
+    start = _align(len(MAGIC) + 4 + len(header))
+    header += b' ' * (start - len(MAGIC) - 4 - len(header))
+
+    parts = [MAGIC, struct.pack('<I', len(header)), header]
+    for a in arrays:
+        parts.append(a.tobytes())
+        parts.append(b'\0' * (_align(a.nbytes) - a.nbytes))
+    return b''.join(parts)
+
+
+def decode(buffer):
+    """
+    Decodes the output of encode(), arrays are read-only views on buffer.
+    """
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise Exception('Invalid binary response, magic bytes are missing')
+    header_length, = struct.unpack_from('<I', buffer, len(MAGIC))
+    start = len(MAGIC) + 4
+    header = json.loads(bytes(buffer[start:start + header_length]))
+    start += header_length
+    arrays = [np.frombuffer(buffer, dtype=spec['dtype'],
+                            count=int(np.prod(spec['shape'], dtype=np.int64)),
+                            offset=start + spec['offset']).reshape(spec['shape'])
+              for spec in header['arrays']]
+
+    def restore(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and '__array__' in value:
+                return arrays[value['__array__']]
+            return {k: restore(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [restore(v) for v in value]
+        return value
+
+    return restore(header['data'])
@@ -0,0 +1,20 @@
+from modules import cache
+
+
+def test_content_pages_through_deletions(tmp_path):
+    cache.init(str(tmp_path), log_actions=False)
+    for i in range(7):
+        cache.write_dict_json(f'data_x__clf_{i}_args', {'i': i})
+    token = cache.content(since=None)['token']
+
+    # all entries are removed at once, more than fit into a page
+    cache.delete('data_x__clf_')
+    deleted = []
+    more = True
+    while more:
+        result = cache.content(limit=3, since=token)
+        deleted += result['deleted']
+        token = result['token']
+        more = result['more']
+    assert sorted(deleted) == [f'data_x__clf_{i}_args.json' for i in range(7)]
+    assert cache.content(since=token)['deleted'] == []
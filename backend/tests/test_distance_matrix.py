@@ -0,0 +1,24 @@
+import numpy as np
+from scipy.spatial.distance import pdist
+from modules import distance_matrix
+
+
+def test_euclidean_float32_matches_pdist():
+    rng = np.random.RandomState(0)
+    data = rng.rand(50, 1000).astype(np.float32)
+    # near-duplicate rows must not get a distance of 0
+    data[1] = data[0] + 1e-4
+    expected = pdist(data.astype(np.float64), 'euclidean')
+    distances = distance_matrix.pairwise_distances(data, 'euclidean')
+    np.testing.assert_allclose(distances, expected, rtol=1e-5, atol=1e-6)
+    assert distances[0] > 0
+
+
+def test_metrics_float16_match_pdist():
+    rng = np.random.RandomState(1)
+    data = rng.rand(30, 200).astype(np.float16)
+    for metric in ('euclidean', 'cosine', 'correlation'):
+        expected = pdist(data.astype(np.float64), metric)
+        distances = distance_matrix.pairwise_distances(data, metric,
+                                                       max_block_bytes=1024)
+        np.testing.assert_allclose(distances, expected, rtol=1e-5, atol=1e-6)
@@ -1,10 +1,97 @@
 const Api = {
     callServerApi: callServerApi,
     loadClassificationResults: loadClassificationResults,
+    decodeBinaryResponse: decodeBinaryResponse,
 }
 
 export default Api;
 
+// content type of the binary format, requested with args.format = 'binary'
+const BINARY_MIME_TYPE = 'application/x-ndarray-bundle';
+
+const TYPED_ARRAYS = {
+    '<f4': Float32Array,
+    '<f8': Float64Array,
+    '|i1': Int8Array,
+    '<i2': Int16Array,
+    '<i4': Int32Array,
+    '|u1': Uint8Array,
+    '<u2': Uint16Array,
+    '<u4': Uint32Array,
+};
+
+/**
+ * Parses a response as JSON or, if the server sent it, the binary format.
+ * @param {Response} response fetch response
+ * @returns {object} the response data
+ */
+async function parseResponse(response) {
+    const type = response.headers.get('Content-Type') || '';
+    if (type.startsWith(BINARY_MIME_TYPE)) {
+        return decodeBinaryResponse(await response.arrayBuffer());
+    }
+    return response.json();
+}
+
+/**
+ * Decodes the binary response format (see backend/modules/transport.py).
+ * Arrays become typed arrays, rows of multi-dimensional arrays are
+ * views on the buffer, so X[i][j] works like for JSON arrays.
+ * @param {ArrayBuffer} buffer response body
+ * @returns {object} the response data
+ */
+function decodeBinaryResponse(buffer) {
+    const view = new DataView(buffer);
+    const headerLength = view.getUint32(4, true);
+    const headerBytes = new Uint8Array(buffer, 8, headerLength);
+    const header = JSON.parse(new TextDecoder().decode(headerBytes));
+    const start = 8 + headerLength;
+
+    const arrays = header.arrays.map(({ dtype, shape, offset }) => {
+        const TypedArray = TYPED_ARRAYS[dtype];
+        const size = shape.reduce((a, b) => a * b, 1);
+        const flat = new TypedArray(buffer, start + offset, size);
+        return reshape(flat, shape);
+    });
+
+    const restore = (value) => {
+        if (Array.isArray(value)) {
+            return value.map(restore);
+        }
+        if (value !== null && typeof value === 'object') {
+            const keys = Object.keys(value);
+            if (keys.length === 1 && keys[0] === '__array__') {
+                return arrays[value.__array__];
+            }
+            const result = {};
+            for (let key of keys) {
+                result[key] = restore(value[key]);
+            }
+            return result;
+        }
+        return value;
+    };
+    return restore(header.data);
+}
+
+/**
+ * Splits a flat typed array into nested arrays of row views.
+ * @param {TypedArray} flat array data
+ * @param {number[]} shape shape of the array
+ * @returns {TypedArray|TypedArray[]} nested array
+ */
+function reshape(flat, shape) {
+    if (shape.length <= 1) {
+        return flat;
+    }
+    const rowSize = flat.length / shape[0];
+    const rows = [];
+    for (let i = 0; i < shape[0]; i++) {
+        rows.push(reshape(flat.subarray(i * rowSize, (i + 1) * rowSize), shape.slice(1)));
+    }
+    return rows;
+}
+
 /**
  * Loads datasets from the server.
  * @param {string} baseUrl protocol, host and port of the server, e.g. 'http://127.0.0.1:12345/'
@@ -25,7 +112,7 @@ async function callServerApi(
         const url = `${baseUrl}?args=${encoded}`;
         try {
             const response = await fetch(url);
-            const data = await response.json();
+            const data = await parseResponse(response);
             const result = {
                 request: args,
                 data
@@ -45,19 +132,21 @@ async function callServerApi(
  * Loads all classification results in one request.
  * @param {string} baseUrl protocol, host and port of the server, e.g. 'http://127.0.0.1:12345/'
  * @param {string[]} files an array classification file names.
+ * @param {string} format 'json' or 'binary'
  * @returns {object[]} the response data
  */
-async function loadClassificationResults(baseUrl, files) {
+async function loadClassificationResults(baseUrl, files, format = 'json') {
     console.log('Classification Results:');
     const args = {
         'action': 'get_clf_results',
-        'files': files
+        'files': files,
+        'format': format
     }
     const encoded = encodeURIComponent(JSON.stringify(args));
     const url = `${baseUrl}?args=${encoded}`;
 
     const response = await fetch(url);
-    const data = await response.json();
+    const data = await parseResponse(response);
     const { classifiers, errors } = data;
 
     if (!classifiers || (errors && errors.length > 0)) {